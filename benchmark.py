@@ -0,0 +1,177 @@
+# Benchmarks of the synthesizer on the tests of tests.py and experiments.py, compared against a stored baseline
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+try:
+    import resource
+except ImportError:  # peak memory is then not measured
+    resource = None
+
+TEST_MODULES = ["tests"]
+EXPERIMENT_MODULES = ["experiments"]  # mostly unbounded searches, so they are only run when asked for
+DEFAULT_BASELINE = "benchmark_baseline.json"
+TOLERANCE = 0.25  # relative increase of a measurement that is a regression
+MIN_TIME_DIFFERENCE = 0.05  # seconds of wall time below which a difference is noise, whatever the tolerance
+# measurements that are compared against the baseline; the others are only reported
+COMPARED = ["seconds", "candidates", "evaluations", "peak_rss"]
+
+
+def find_cases(modules, patterns=()):
+    """
+    The ids of the test methods of the modules (e.g. "tests.SynthesizerTests.test_arithm") that contain one of the
+    patterns, or all of them if there are none.
+    """
+    cases = []
+
+    def collect(suite):
+        for it in suite:
+            if isinstance(it, unittest.TestSuite):
+                collect(it)
+            elif not patterns or any(pattern in it.id() for pattern in patterns):
+                cases.append(it.id())
+
+    for module in modules:
+        collect(unittest.defaultTestLoader.loadTestsFromName(module))
+    return cases
+
+
+def run_case(case):
+    """
+    Runs the test case in this process and measures it. The counts are of the syntheses done with the module-level
+    functions of synthesizer (not those of other sessions or of worker processes).
+    """
+    import synthesizer
+    test = unittest.defaultTestLoader.loadTestsFromName(case)
+    result = unittest.TestResult()
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        test.run(result)
+        seconds = time.perf_counter() - started
+    session = synthesizer.current()
+    return {
+        "passed": result.wasSuccessful(),
+        "seconds": seconds,
+        "candidates": sum(session.candidates),
+        "candidates_by_height": session.candidates,
+        "evaluations": session.evaluations,
+        "oe_hits": session.oe_hits,
+        "cache": session.cache.stats(),
+        "terms": len(session.terms),
+        "results_cached": len(session.prog_result_cache),
+        # in kilobytes, the unit of Linux (macOS gives bytes)
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None,
+    }
+
+
+def measure(case, repeat, timeout):
+    """
+    Runs the test case repeat times, each in a new process so caches and peak memory start from scratch, with a fixed
+    hash seed so the enumeration order is the same every time. Returns the measurements of the fastest run, or None if
+    a run did not finish within timeout seconds.
+    """
+    env = dict(os.environ, PYTHONHASHSEED="0")
+    runs = []
+    for _ in range(repeat):
+        try:
+            process = subprocess.run([sys.executable, __file__, "--run-case", case], env=env, capture_output=True,
+                                     text=True, timeout=timeout, cwd=os.path.dirname(os.path.abspath(__file__)))
+        except subprocess.TimeoutExpired:
+            return None
+        if process.returncode:
+            return {"passed": False, "error": process.stderr.strip().splitlines()[-1:]}
+        runs.append(json.loads(process.stdout.strip().splitlines()[-1]))
+    return min(runs, key=lambda it: it["seconds"])
+
+
+def compare(results, baseline, tolerance):
+    """
+    The regressions of results against the baseline, as (case, description) pairs: cases that passed and now fail or
+    time out, and compared measurements that grew by more than tolerance.
+    """
+    regressions = []
+    for case, old in baseline.items():
+        new = results.get(case, False)
+        if new is False or old is None or not old.get("passed"):
+            continue  # not run this time, or not worth comparing
+        if new is None or not new["passed"]:
+            regressions.append((case, "timed out" if new is None else "failed"))
+            continue
+        for name in COMPARED:
+            if old.get(name) is None or new.get(name) is None:
+                continue
+            if new[name] > old[name] * (1 + tolerance) and \
+                    (name != "seconds" or new[name] - old[name] > MIN_TIME_DIFFERENCE):
+                regressions.append((case, f"{name} {format_value(old[name])} -> {format_value(new[name])}"))
+    return regressions
+
+
+def format_value(value):
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+def print_table(results, baseline):
+    print(f"{'case':<60} {'seconds':>9} {'baseline':>9} {'candidates':>11} {'evaluations':>12} {'peak RSS':>10}")
+    for case, new in results.items():
+        old = baseline.get(case) or {}
+        name = case.split(".", 1)[-1]
+        if new is None or not new["passed"]:
+            print(f"{name:<60} {'timeout' if new is None else 'failed':>9}")
+            continue
+        old_seconds = format_value(old["seconds"]) if old.get("seconds") is not None else "-"
+        print(f"{name:<60} {new['seconds']:>9.3f} {old_seconds:>9} {new['candidates']:>11} {new['evaluations']:>12} "
+              f"{new['peak_rss'] if new['peak_rss'] is not None else '-':>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the synthesizer on the tests of tests.py (and "
+                                                 "experiments.py), and compares the results against a baseline.")
+    parser.add_argument("patterns", nargs="*", help="only run the tests whose ids contain one of these")
+    parser.add_argument("--experiments", action="store_true", help="also run the tests of experiments.py")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of every test, the fastest one is kept")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds a test may run before it is stopped")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="JSON file of the results to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="relative increase of a measurement that is a regression")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)  # used by the processes running the tests
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case)))
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.update_baseline:
+        # the measurements depend on the machine, so a baseline is stored on it rather than shipped with the code
+        print(f"no baseline in {args.baseline} to compare against, store one with --update-baseline", file=sys.stderr)
+        return 2
+    modules = TEST_MODULES + (EXPERIMENT_MODULES if args.experiments else [])
+    results = {case: measure(case, args.repeat, args.timeout) for case in find_cases(modules, args.patterns)}
+    print_table(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({**baseline, **results}, f, indent=2)
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for case, description in regressions:
+        print(f"REGRESSION: {case}: {description}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,19 @@
 
 debug = False
 prove = False
+proof_timeout = 1000  # milliseconds Z3 may spend proving a single equivalence, 0 for no limit
 depth_for_observational_equivalence = 5
+compose_results = True  # build results of derived programs from those of their subexpressions when it is safe
+eval_cache_size = 100000  # compiled programs kept by eval_cached, None for no limit
+term_string_cache_size = 100000  # sources of enumerated expressions kept, the others are rebuilt when needed
+enumeration_cache = None  # path of a file caching enumerated expressions between runs, None to disable it
+workers = 0  # worker processes evaluating candidates in parallel, 0 to evaluate them in the synthesizer's process
+eval_time_limit = 1.0  # seconds a candidate may run on one input before it is killed, None for no limit
+eval_recursion_limit = None  # nested calls a candidate may make before it is killed, None for Python's recursion limit
+vectorize = True  # evaluate arithmetic and boolean programs on all examples at once with NumPy, when it is installed
+cegis_examples = None  # examples of each spec to start enumerating with, adding failing ones as needed; None for all
+stats = False  # count and time the enumeration by rule, height and equivalence check outcome (see stats.py)
+profile = False  # like stats, also counting the expressions of every rule that fail on an example (see stats.py)
 
 
 def set_debug(value):
@@ -15,6 +27,66 @@ def set_prove(value):
     prove = value
 
 
+def set_proof_timeout(value):
+    global proof_timeout
+    proof_timeout = value
+
+
 def set_depth_for_observational_equivalence(value):
     global depth_for_observational_equivalence
     depth_for_observational_equivalence = value
+
+
+def set_compose_results(value):
+    global compose_results
+    compose_results = value
+
+
+def set_eval_cache_size(value):
+    global eval_cache_size
+    eval_cache_size = value
+
+
+def set_workers(value):
+    global workers
+    workers = value
+
+
+def set_enumeration_cache(value):
+    global enumeration_cache
+    enumeration_cache = value
+
+
+def set_vectorize(value):
+    global vectorize
+    vectorize = value
+
+
+def set_eval_time_limit(value):
+    global eval_time_limit
+    eval_time_limit = value
+
+
+def set_eval_recursion_limit(value):
+    global eval_recursion_limit
+    eval_recursion_limit = value
+
+
+def set_term_string_cache_size(value):
+    global term_string_cache_size
+    term_string_cache_size = value
+
+
+def set_cegis_examples(value):
+    global cegis_examples
+    cegis_examples = value
+
+
+def set_stats(value):
+    global stats
+    stats = value
+
+
+def set_profile(value):
+    global profile
+    profile = value
@@ -0,0 +1,63 @@
+# Persistent cache of the terms enumerated for a grammar, shared between runs
+
+import hashlib
+import pickle
+import sqlite3
+from contextlib import closing
+from terms import TreeRewritingSystem
+
+FORMAT_VERSION = 2  # bump when the stored records change
+
+
+def grammar_key(rules, nonterminals, trs):
+    """
+    A hash of everything the enumeration of heights without observational equivalence depends on.
+    """
+    if isinstance(trs, TreeRewritingSystem):
+        rewriting = trs.description
+    else:
+        rewriting = [(pattern.pattern, replacement) for pattern, replacement in trs or []]
+    description = repr((FORMAT_VERSION, [(rule.lhs, rule.rhs) for rule in rules], sorted(nonterminals), rewriting))
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class EnumerationCache:
+    """
+    A sqlite file holding, for every grammar (see grammar_key) and height that was enumerated without observational
+    equivalence, a record of what the height added: the new terms, the new instances of every nonterminal with the keys
+    they are joined by and the terms yielded as programs. Since nothing there depends on the examples, a later run can
+    replay these records instead of enumerating the heights again. Results of programs are not stored.
+    Rules are stored by their index in the list of rules.
+    """
+
+    def __init__(self, path, rules):
+        self.path = path
+        with closing(sqlite3.connect(path)) as connection, connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS heights (grammar TEXT, height INTEGER, record BLOB, "
+                               "PRIMARY KEY (grammar, height))")
+        self.rules = rules
+        self.indices = {rule: i for i, rule in enumerate(rules)}
+
+    def load(self, key):
+        """
+        The records of the consecutive heights cached for the grammar, from height 0 (ground expressions) up.
+        """
+        records = []
+        with closing(sqlite3.connect(self.path)) as connection:
+            rows = connection.execute("SELECT height, record FROM heights WHERE grammar = ? ORDER BY height",
+                                      (key,)).fetchall()
+        for height, record in rows:
+            if height != len(records):
+                break
+            entries, new_instances, yields = pickle.loads(record)
+            entries = [(None if rule is None else self.rules[rule], children, fingerprint, mentions_input)
+                       for rule, children, fingerprint, mentions_input in entries]
+            records.append((entries, new_instances, yields))
+        return records
+
+    def save(self, key, height, entries, new_instances, yields):
+        entries = [(None if rule is None else self.indices[rule], children, fingerprint, mentions_input)
+                   for rule, children, fingerprint, mentions_input in entries]
+        with closing(sqlite3.connect(self.path)) as connection, connection:
+            connection.execute("INSERT OR IGNORE INTO heights VALUES (?, ?, ?)",
+                               (key, height, pickle.dumps((entries, new_instances, yields))))
@@ -0,0 +1,149 @@
+# Counters and timers of the enumeration, collected when config.stats or config.profile is set
+
+import json
+import time
+from collections import Counter
+
+# the outcomes of equivalence checks (see SynthesisStats) that prune an expression, by what pruned it
+PRUNED_BY_OE = ("SEEN", "OBSERVATIONALLY_EQUIVALENT", "PROVABLY_EQUIVALENT")
+PRUNED_BY_CONSTANT = ("SEEN_CONSTANT", "SEEN_NOT_A_CONSTANT")
+PROFILE_COLUMNS = ["seconds", "built", "kept", "pruned_oe", "pruned_trs", "pruned_constant", "eval_failures"]
+
+
+class RuleStats:
+    __slots__ = ("built", "kept", "seconds", "outcomes", "pruned_trs", "eval_failures")
+
+    def __init__(self):
+        self.built = 0  # expressions built by applying the rule
+        self.kept = 0  # of them, the ones not equivalent to any expression seen before
+        self.seconds = 0.0  # spent applying the rule, including checking the programs it built on the examples
+        self.outcomes = Counter()  # of the equivalence checks of the expressions it built
+        self.pruned_trs = 0  # expressions whose normal form by the term rewriting rules was already built
+        self.eval_failures = 0  # expressions failing on an example, only counted by the profiler
+
+    def as_dict(self):
+        return {name: dict(self.outcomes) if name == "outcomes" else getattr(self, name) for name in self.__slots__}
+
+
+class HeightStats:
+    __slots__ = ("built", "kept", "candidates", "seconds")
+
+    def __init__(self):
+        self.built = 0
+        self.kept = 0
+        self.candidates = 0  # programs checked on the examples
+        self.seconds = 0.0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class SynthesisStats:
+    """
+    The counters and timers of a synthesis: by rule, by height, and by the outcome of the equivalence check of every
+    expression built (the name of a ConstantResult when the check of constants decided it, see equiv_to_any).
+    They are updated as the enumeration goes on, so they can be read from another thread while it runs, for example
+    with snapshot(). The profiler (config.profile) also counts the expressions of every rule that fail on an example,
+    and profile() and report() attribute the synthesis to the rules and nonterminals of the grammar.
+    """
+
+    def __init__(self, profiling=False):
+        self.profiling = profiling
+        self.started = time.perf_counter()
+        self.height_started = self.started
+        self.rules = {}  # CfgRule -> RuleStats
+        self.heights = []  # HeightStats of every height started
+        self.outcomes = Counter()
+        self.current = None  # the RuleStats of the rule being applied, if one is
+
+    def rule(self, rule):
+        stats = self.rules.get(rule)
+        if stats is None:
+            stats = self.rules[rule] = RuleStats()
+        return stats
+
+    def height(self, height):
+        while len(self.heights) <= height:
+            self.heights.append(HeightStats())
+        return self.heights[height]
+
+    def outcome(self, name):
+        self.outcomes[name] += 1
+        if self.current is not None:
+            self.current.outcomes[name] += 1
+
+    def rule_done(self, rule, height, built, kept, seconds, eval_failures=0):
+        for stats in self.rule(rule), self.height(height):
+            stats.built += built
+            stats.kept += kept
+        rule_stats = self.rule(rule)
+        rule_stats.seconds += seconds
+        rule_stats.eval_failures += eval_failures
+        self.current = None
+
+    def height_done(self, height):
+        now = time.perf_counter()
+        self.height(height).seconds += now - self.height_started
+        self.height_started = now
+
+    def snapshot(self):
+        """
+        A copy of the stats made of dicts, lists and numbers, which json.dumps accepts.
+        """
+        return {
+            "seconds": time.perf_counter() - self.started,
+            "rules": {str(rule): stats.as_dict() for rule, stats in list(self.rules.items())},
+            "heights": [stats.as_dict() for stats in list(self.heights)],
+            "outcomes": dict(self.outcomes),
+        }
+
+    def profile(self):
+        """
+        The time, expressions built, kept and pruned (by observational equivalence or proofs, by term rewriting or
+        by the check of constants) and expressions failing on an example, of every rule and of every nonterminal (the
+        sums of its rules). Returns {"rules": [...], "nonterminals": [...]} with a dict for each, slowest first.
+        """
+        rules = []
+        for rule, stats in list(self.rules.items()):
+            rules.append({
+                "rule": str(rule),
+                "nonterminal": rule.lhs,
+                "seconds": stats.seconds,
+                "built": stats.built,
+                "kept": stats.kept,
+                "pruned_oe": sum(stats.outcomes[it] for it in PRUNED_BY_OE),
+                "pruned_trs": stats.pruned_trs,
+                "pruned_constant": sum(stats.outcomes[it] for it in PRUNED_BY_CONSTANT),
+                "eval_failures": stats.eval_failures,
+            })
+        nonterminals = {}
+        for row in rules:
+            total = nonterminals.setdefault(row["nonterminal"], dict.fromkeys(PROFILE_COLUMNS, 0))
+            for column in PROFILE_COLUMNS:
+                total[column] += row[column]
+        return {
+            "rules": sorted(rules, key=lambda it: -it["seconds"]),
+            "nonterminals": sorted(({"nonterminal": k, **v} for k, v in nonterminals.items()),
+                                   key=lambda it: -it["seconds"]),
+        }
+
+    def report(self, format="table"):
+        """
+        The profile as a table of the nonterminals followed by one of the rules, or as JSON if format is "json".
+        """
+        profile = self.profile()
+        if format == "json":
+            return json.dumps(profile, indent=2)
+        if format != "table":
+            raise ValueError(f"unknown report format {format!r}, expected 'table' or 'json'")
+        width = max([len(it["rule"]) for it in profile["rules"]] + [len("nonterminal")])
+        header = f"{{:<{width}}}" + " {:>15}" * len(PROFILE_COLUMNS)
+        lines = []
+        for name, rows in ("nonterminal", profile["nonterminals"]), ("rule", profile["rules"]):
+            if lines:
+                lines.append("")
+            lines.append(header.format(name, *PROFILE_COLUMNS))
+            for row in rows:
+                lines.append(header.format(row[name], f"{row['seconds']:.3f}",
+                                           *(row[it] for it in PROFILE_COLUMNS[1:])))
+        return "\n".join(lines)
@@ -1,4 +1,6 @@
 import re
+from collections import OrderedDict
+from terms import TreeRewritingSystem, string_fingerprint
 
 
 class CfgRule:
@@ -26,6 +28,7 @@ class CfgRule:
 TOKEN_REGEX = re.compile(r"^[_A-Z\d]+$|^[^A-Z]+$")
 NONTERMINAL_REGEX = re.compile(r"^[_A-Z\d]*[A-Z]+[_A-Z\d]*$")
 separation_tokens = ["(", ")", ",", "[", "]", "=", "->", ".", "*", "+", "-", "/", "%", ":"]
+GROUP_REFERENCE_REGEX = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
 escapes = {"\\s": " ", "\\a": "->", "\\p": "|", "\\t": "\t", "\\n": "\n", "True": "(1==1)", "False": "(1==0)"}
 
 
@@ -62,7 +65,7 @@ def parse_internal(string: str, sep="::=") -> (list, list):  # (rules, nontermin
     return ret, nonterminals
 
 
-def parse(string: str) -> (list, list):  # (rules, nonterminals)
+def parse(string: str) -> "Grammar":
     ret, nonterminals = parse_internal(string)
     for rule in ret:
         for token in rule.rhs:
@@ -81,9 +84,229 @@ def parse(string: str) -> (list, list):  # (rules, nonterminals)
     for nonterminal in nonterminals:
         if nonterminal not in [rule.lhs for rule in ret]:
             raise ValueError(f"There is no rule for {nonterminal}. This is an error.")
-    return ret, nonterminals
+    return Grammar(ret, nonterminals)
+
+
+class Grammar:
+    """
+    A grammar compiled for the enumeration. Nonterminals that can't be reached from the initial nonterminal or that
+    derive no expression are dropped along with their rules, since the enumeration could never use their expressions.
+    The nonterminals of each rule, its rules by left-hand side and the nonterminals each nonterminal derives through
+    unit rules (NT1 ::= NT2) are computed once here instead of on every height.
+    Unpacks as (rules, nonterminals).
+    """
+
+    def __init__(self, rules, nonterminals, initial="PROGRAM"):
+        self.initial = initial
+        nonterminals = set(nonterminals)
+        productive = set()
+        changed = True
+        while changed:
+            changed = False
+            for rule in rules:
+                if rule.lhs not in productive and all(it in productive for it in rule.rhs if it in nonterminals):
+                    productive.add(rule.lhs)
+                    changed = True
+        rules = [rule for rule in rules if rule.lhs in productive and
+                 all(it in productive for it in rule.rhs if it in nonterminals)]
+        reachable = {initial}
+        changed = True
+        while changed:
+            changed = False
+            for rule in rules:
+                if rule.lhs in reachable:
+                    for it in rule.rhs:
+                        if it in nonterminals and it not in reachable:
+                            reachable.add(it)
+                            changed = True
+        self.rules = [rule for rule in rules if rule.lhs in reachable]
+        self.nonterminals = reachable
+        self.rules_by_lhs = {it: [] for it in self.nonterminals}
+        self.positions = {}  # rule -> the indices of the nonterminals in its right-hand side
+        self.arguments = {}  # rule -> the nonterminals in its right-hand side, from left to right
+        for rule in self.rules:
+            self.rules_by_lhs[rule.lhs].append(rule)
+            self.positions[rule] = tuple(i for i, token in enumerate(rule.rhs) if token in self.nonterminals)
+            self.arguments[rule] = tuple(rule.rhs[i] for i in self.positions[rule])
+        self.unit_rules = [rule for rule in self.rules if self.is_unit(rule)]
+        # nonterminal -> the other nonterminals whose expressions are its expressions through chains of unit rules
+        self.units = {}
+        for nonterminal in self.nonterminals:
+            found = [nonterminal]
+            for it in found:
+                for rule in self.rules_by_lhs[it]:
+                    if self.is_unit(rule) and rule.rhs[0] not in found:
+                        found.append(rule.rhs[0])
+            self.units[nonterminal] = found[1:]
+
+    def __iter__(self):
+        return iter((self.rules, self.nonterminals))
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        return (self.rules, self.nonterminals)[index]
+
+    def is_unit(self, rule):
+        return len(rule.rhs) == 1 and rule.rhs[0] in self.nonterminals
+
+    def arity(self, rule):
+        return len(self.positions[rule])
+
+
+class TermRewritingSystem(list):
+    """
+    A list of (regex, replacement) rules, compiled for normalizing many strings.
+    All the regexes are also combined into one alternation, so a string no rule applies to (the usual case) is
+    recognized by a single scan, and normal forms are remembered for the max_normal_forms most recently used strings.
+    """
+
+    def __init__(self, rules, max_normal_forms=100000):
+        super().__init__(rules)
+        self.max_normal_forms = max_normal_forms
+        self.normal_forms = OrderedDict()
+        self.combined = None
+        # references to groups would refer to other rules' groups once combined
+        if rules and not any(GROUP_REFERENCE_REGEX.search(pattern.pattern) for pattern, _ in rules):
+            try:
+                self.combined = re.compile("|".join(f"(?:{pattern.pattern})" for pattern, _ in rules))
+            except re.error:
+                pass
+
+    def normalize(self, string):
+        """
+        The normal form of string: the rules are applied in order, pass after pass, until none applies.
+        """
+        if self.combined is not None and not self.combined.search(string):
+            return string
+        normal_form = self.normal_forms.get(string)
+        if normal_form is not None:
+            self.normal_forms.move_to_end(string)
+            return normal_form
+        normal_form = string
+        changed = True
+        while changed:
+            changed = False
+            for pattern, replacement in self:
+                if pattern.search(normal_form):
+                    normal_form = pattern.sub(replacement, normal_form)
+                    changed = True
+        self.normal_forms[string] = normal_form
+        if len(self.normal_forms) > self.max_normal_forms:
+            self.normal_forms.popitem(last=False)
+        return normal_form
 
 
-def parse_term_rewriting_rules(string: str) -> list:
+def parse_term_rewriting_rules(string: str) -> TermRewritingSystem:
     ret, _ = parse_internal(string, sep="->")
-    return [(re.compile(''.join(list(map(replace_escapes, it.lhs.split())))), ''.join(it.rhs)) for it in ret]
+    return TermRewritingSystem([(re.compile(''.join(list(map(replace_escapes, it.lhs.split())))), ''.join(it.rhs))
+                                for it in ret])
+
+
+def parse_pattern(tokens, nonterminal, rules, matched=False):
+    """
+    Parses tokens as an expression of nonterminal in the grammar given by rules, where a token NT or NT_<number>
+    is a variable standing for any expression of the nonterminal NT. Unit rules are skipped over. Returns a pattern
+    (see terms.TreeRewritingSystem) whose root is a variable or a node, or None if the tokens can't be derived from
+    nonterminal.
+    In a pattern that is matched, variables must be in places of their own nonterminal: through a unit rule NT1 ::= NT,
+    the variable NT would also match the expressions of NT1 that are not expressions of NT.
+    """
+    nonterminals = {rule.lhs for rule in rules}
+    memo = {}
+
+    def variable(token):
+        # the nonterminal a token stands for as a variable
+        if token in nonterminals:
+            return token
+        base = re.sub(r"_\d+$", "", token)
+        return base if base in nonterminals else None
+
+    def parse_span(nt, start, end, unit=False):
+        if (nt, start, end, unit) in memo:
+            return memo[nt, start, end, unit]
+        memo[nt, start, end, unit] = None  # guards against cycles of unit rules
+        ret = None
+        if end - start == 1 and variable(tokens[start]) == nt and not (matched and unit):
+            ret = ("var", tokens[start])
+        for rule in rules:
+            if ret is not None:
+                break
+            if rule.lhs != nt:
+                continue
+            if len(rule.rhs) == 1 and rule.rhs[0] in nonterminals:
+                ret = parse_span(rule.rhs[0], start, end, True)
+                continue
+            children = parse_rhs(rule.rhs, 0, start, end)
+            if children is not None:
+                ret = ("node", rule, tuple(children))
+        memo[nt, start, end, unit] = ret
+        return ret
+
+    def parse_rhs(rhs, index, start, end):
+        # the patterns of the nonterminals of rhs[index:] deriving tokens[start:end], or None
+        if index == len(rhs):
+            return [] if start == end else None
+        token = rhs[index]
+        if token not in nonterminals:
+            if start < end and tokens[start] == token:
+                return parse_rhs(rhs, index + 1, start + 1, end)
+            return None
+        for middle in range(start + 1, end + 1):
+            child = parse_span(token, start, middle)
+            if child is not None:
+                rest = parse_rhs(rhs, index + 1, middle, end)
+                if rest is not None:
+                    return [ground(child, start, middle)] + rest
+        return None
+
+    def ground(pattern, start, end):
+        # subexpressions without variables are matched by their source
+        if pattern[0] == "node" and all(child[0] == "ground" for child in pattern[2]):
+            string = ''.join(tokens[start:end])
+            return "ground", string_fingerprint(string), string, pattern
+        return pattern
+
+    return parse_span(nonterminal, 0, len(tokens))
+
+
+def parse_tree_rewriting_rules(string: str, parsed) -> TreeRewritingSystem:
+    """
+    Parses rules of the form LHS -> RHS, where both sides are expressions of the grammar parsed (given like its
+    rules, using escapes) that may contain variables: a nonterminal NT, or NT_<number> to have several variables of
+    the same nonterminal, matches any expression of NT. The rules are applied to the terms built by the synthesizer
+    according to the structure of the grammar rather than to strings.
+    """
+    rules, _ = parsed
+    ret, _ = parse_internal(string, sep="->")
+    patterns = []
+    for it in ret:
+        lhs = list(map(replace_escapes, it.lhs.split()))
+        rhs = it.rhs
+        for nonterminal in sorted({rule.lhs for rule in rules}):
+            lhs_pattern = parse_pattern(lhs, nonterminal, rules, matched=True)
+            if lhs_pattern is None or lhs_pattern[0] != "node":
+                continue
+            rhs_pattern = parse_pattern(rhs, lhs_pattern[1].lhs, rules)
+            if rhs_pattern is not None:
+                if rhs_pattern[0] == "node" and all(child[0] == "ground" for child in rhs_pattern[2]):
+                    rhs_pattern = ("ground", string_fingerprint(''.join(rhs)), ''.join(rhs), rhs_pattern)
+                break
+        else:
+            raise ValueError(f"{it} does not rewrite an expression of the grammar into another expression of the same "
+                             f"nonterminal. This is an error.")
+        variables = {it[1] for it in pattern_variables(lhs_pattern)}
+        if not {it[1] for it in pattern_variables(rhs_pattern)} <= variables:
+            raise ValueError(f"{it} has variables on its right-hand side that are not on its left-hand side. This is "
+                             f"an error.")
+        patterns.append((lhs_pattern, rhs_pattern))
+    return TreeRewritingSystem(patterns, [str(it) for it in ret])
+
+
+def pattern_variables(pattern):
+    if pattern[0] == "var":
+        yield pattern
+    elif pattern[0] == "node":
+        for child in pattern[2]:
+            yield from pattern_variables(child)
@@ -16,23 +16,49 @@
 # OE benchmarking
 # Term rewriting systems
 
-import profile
 from typing import List
-from z3 import Solver, Int, ForAll, sat, Z3Exception, Exists
+from z3 import Context, Solver, Int, unsat, Z3Exception, BoolRef
 from stdlib import *
 import syntax
 from syntax import CfgRule
-import cProfile
-import random
+from terms import TermStore, TreeRewritingSystem
+from enumeration_cache import EnumerationCache, grammar_key
+from vectorized import PlainResults, get_vectorized_evaluator
+from stats import SynthesisStats
 from enum import Enum
 import config
 from ordered_set import OrderedSet
+from collections import OrderedDict, namedtuple
 import time
+import itertools
+import heapq
+import types
+import builtins
+import dis
+import ast
+import re
+import multiprocessing
+import pickle
+import contextlib
+import signal
+import sys
+import threading
+import asyncio
 
 set_used = OrderedSet
-prog_result_cache = {}
-cache = {}
-seen_constants = set_used()
+local = threading.local()  # the Synthesizer of each thread, see current()
+worker_inputs = None  # the example inputs, in a worker process
+PARALLEL_CHUNK_SIZE = 1024  # candidates evaluated by the workers, or vectorizer, at a time
+# the state of a synthesis, which module attributes of these names get from the current thread's Synthesizer
+SESSION_STATE = {"terms", "examples", "prog_result_cache", "partial_results", "prog_constant_cache", "seen_constants",
+                 "equivalents", "semantic_functions", "provers", "pool", "vectorizer", "scheduler", "cache", "killed",
+                 "candidates", "evaluations", "oe_hits", "stats"}
+RECURSION_SLACK = 100  # frames between do_synthesis and the candidates it evaluates
+CANCELLATION_CHECK_INTERVAL = 64  # terms built between checks of the cancellation token
+SCHEDULING_INTERVAL = 256  # checks of examples between updates of the order they are checked in
+UNKNOWN = object()  # the result of a program on an example it was not evaluated on yet
+# how programs are enumerated: expand, expand_top_down, or both of them taking turns
+STRATEGIES = ("bottom-up", "top-down", "both")
 
 
 class ConstantResult(Enum):
@@ -49,57 +75,1208 @@ class NoResult:  # thank you Bidusa
         return False
 
 
+class Unencodable(Exception):
+    pass
+
+
+class EvaluationTimeout(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    """
+    Stops the synthesis it is passed to once cancel() is called (from any thread), once its parent is cancelled, or
+    after timeout seconds (never if timeout is None or negative).
+    """
+
+    def __init__(self, timeout=None, parent=None):
+        self.deadline = None if timeout is None or timeout < 0 else time.monotonic() + timeout
+        self.parent = parent
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def expired(self):
+        return self.cancelled or self.deadline is not None and time.monotonic() >= self.deadline or \
+            self.parent is not None and self.parent.expired()
+
+    def check(self):
+        if self.expired():
+            raise Cancelled()
+
+
+# tags keeping the canonical forms of containers apart from each other and from user values
+_LIST, _TUPLE, _SET, _DICT, _LINKED_LIST = (object() for _ in range(5))
+INVALID = object()  # the key of a result that is not equal to anything, or has no canonical form
+
+
+def results_key(vector):
+    """
+    The canonical form of a results vector, or None if it has a NoResult, so it is not equal to any other.
+    Raises Unencodable like canonical_value.
+    """
+    if isinstance(vector, PlainResults):
+        return tuple(vector)
+    if any(isinstance(it, NoResult) for it in vector):
+        return None
+    return tuple(canonical_value(it) for it in vector)
+
+
+def canonical_value(value):
+    """
+    A hashable stand-in for value, such that the stand-ins of two values are equal exactly when the values are.
+    Raises Unencodable for unhashable values of a type it does not know.
+    """
+    if isinstance(value, linked_list):
+        return _LINKED_LIST, repr(value)  # linked_list equality is by repr
+    if isinstance(value, list):
+        return _LIST, tuple(canonical_value(it) for it in value)
+    if isinstance(value, tuple):
+        return _TUPLE, tuple(canonical_value(it) for it in value)
+    if isinstance(value, (set, frozenset)):
+        return _SET, frozenset(canonical_value(it) for it in value)
+    if isinstance(value, dict):
+        return _DICT, frozenset((k, canonical_value(v)) for k, v in value.items())
+    try:
+        hash(value)
+    except TypeError:
+        raise Unencodable()
+    return value
+
+
+class ObservationalEquivalenceTable:
+    """
+    The programs seen so far for one nonterminal, in a trie keyed by their results on the examples in scheduler
+    order, so a program is only evaluated on the examples it takes to tell it apart from the others.
+    """
+
+    def __init__(self, examples, nonterminal=None, constants=None):
+        session = current()
+        self.examples = examples
+        self.nonterminal = nonterminal
+        if constants is None:
+            constants = session.seen_constants.setdefault(nonterminal, ConstantTable())
+        self.constants = constants
+        self.progs = []
+        self.keys = set()
+        self.order = session.scheduler.order()
+        # a node at depth d maps the keys of the d-th example in order to the nodes below it, or is a leaf program
+        self.trie = {}  # the node at depth -1, where every program has the key None
+        self.unencodable = []  # (prog, results vector) pairs without a canonical form, compared one by one
+        self.full_keys = {}  # leaf -> the canonical form of its results vector, INVALID if it has none
+        self.terms = session.terms
+
+    def __contains__(self, prog):
+        return prog in self.keys
+
+    def __iter__(self):
+        return iter(self.progs)
+
+    def __len__(self):
+        return len(self.progs)
+
+    def key(self, prog, depth):
+        """
+        The canonical form of the result of prog on the depth-th example in order, or INVALID if it has none.
+        """
+        if depth < 0:
+            return None
+        value = result(prog, self.order[depth], self.examples)
+        if isinstance(value, NoResult):
+            return INVALID
+        try:
+            return canonical_value(value)
+        except Unencodable:
+            return INVALID
+
+    def full_key(self, prog, leaf=False):
+        """
+        The canonical form of the results vector of prog, INVALID if it has none, or None if it is not known yet.
+        """
+        if leaf and prog in self.full_keys:
+            return self.full_keys[prog]
+        vector = current().prog_result_cache.get(prog)
+        if vector is None:
+            return None
+        try:
+            key = results_key(vector)
+        except Unencodable:
+            key = None
+        if key is None:
+            key = INVALID
+        if leaf:
+            self.full_keys[prog] = key
+        return key
+
+    def same(self, prog, leaf):
+        """
+        Whether prog and the leaf program are known to have the same results, False if they have a different one, or
+        None if it is not known yet.
+        """
+        prog_key = self.full_key(prog)
+        if prog_key is None or prog_key is INVALID:
+            return None
+        leaf_key = self.full_key(leaf, leaf=True)
+        if leaf_key is None or leaf_key is INVALID:
+            return None
+        return prog_key == leaf_key
+
+    def add(self, prog, joined_by=None):
+        """
+        Adds prog, seen as the instance joined by the given key (by default itself, see instance_key).
+        """
+        if joined_by is None:
+            joined_by = prog
+        if joined_by in self.keys:
+            return
+        self.keys.add(joined_by)
+        self.progs.append(prog)
+        node, depth = self.trie, -1
+        while True:
+            key = self.key(prog, depth)
+            if key is INVALID:
+                self.add_unencodable(prog)
+                return
+            child = node.get(key)
+            if child is None:
+                node[key] = prog
+                return
+            depth += 1
+            if type(child) is dict:
+                node = child
+                continue
+            # a leaf, so prog and child are compared on the following examples until they differ
+            if self.same(prog, child):
+                return  # the first program with these results stays
+            same = []
+            for depth in range(depth, len(self.order)):
+                prog_key, child_key = self.key(prog, depth), self.key(child, depth)
+                if prog_key is INVALID or child_key is INVALID:
+                    if self.add_unencodable(prog) is not None and self.add_unencodable(child) is None:
+                        node[key] = prog  # child is never equal to anything, so it makes room for prog
+                    return
+                if prog_key != child_key:
+                    for it in same:
+                        node[key] = node = {}
+                        key = it
+                    node[key] = {prog_key: prog, child_key: child}
+                    return
+                same.append(prog_key)
+            return  # the first program with these results stays
+
+    def add_examples(self):
+        """
+        Extends the table to the examples added since it was made (see add_example). They come last in its order, so
+        the trie stays valid: its leaves are compared on them when they are reached.
+        """
+        self.order += tuple(range(len(self.order), len(self.examples)))
+        self.full_keys = {}
+        self.unencodable = [(prog, results_vector(prog, self.examples)) for prog, _ in self.unencodable]
+
+    def add_unencodable(self, prog):
+        """
+        Puts prog in the unencodable programs if its results have no canonical form. Returns their canonical form if
+        they have one, and None if they have a NoResult (so prog is never equal to anything) or have no canonical form.
+        """
+        vector = results_vector(prog, self.examples)
+        try:
+            return results_key(vector)
+        except Unencodable:
+            if all(other != prog for other, _ in self.unencodable):
+                self.unencodable.append((prog, vector))
+            return None
+
+    def find(self, prog):
+        """
+        Returns a seen program with the same results as prog, or None if there is none.
+        """
+        node, depth = self.trie, -1
+        while type(node) is dict:
+            key = self.key(prog, depth)
+            if key is INVALID:
+                return self.find_unencodable(prog)
+            node, depth = node.get(key), depth + 1
+            if node is None:
+                return self.find_unencodable(prog) if self.unencodable else None
+        # a leaf with the same results as prog on the examples before depth
+        same = self.same(prog, node)
+        if same is not None:
+            return node if same else self.find_unencodable(prog) if self.unencodable else None
+        for depth in range(depth, len(self.order)):
+            key, other = self.key(prog, depth), self.key(node, depth)
+            if key is INVALID or other is INVALID:
+                self.add_unencodable(node)  # in case it is the one without a canonical form
+                return self.find_unencodable(prog)
+            if key != other:
+                return self.find_unencodable(prog) if self.unencodable else None
+        return node
+
+    def find_unencodable(self, prog):
+        # prog can only be equal to an unencodable program if its results have no canonical form either
+        vector = results_vector(prog, self.examples)
+        try:
+            results_key(vector)
+            return None
+        except Unencodable:
+            for other, results in self.unencodable:
+                if vector == results:
+                    return other
+            return None
+
+
+class ConstantTable:
+    """
+    The constants seen so far for one nonterminal, indexed by the canonical forms of their values.
+    """
+
+    def __init__(self):
+        self.index = {}  # canonical value -> the first constant with it
+        self.unencodable = []  # (prog, value) pairs
+
+    def add(self, prog):
+        value = constant_value(prog)
+        if callable(value) or isinstance(value, NoResult):
+            return  # not equal to any constant
+        try:
+            self.index.setdefault(canonical_value(value), prog)
+        except Unencodable:
+            self.unencodable.append((prog, value))
+
+    def find(self, value):
+        """
+        Returns a seen constant whose value is value, or None if there is none.
+        """
+        try:
+            return self.index.get(canonical_value(value))
+        except Unencodable:
+            for prog, other in self.unencodable:
+                if other == value:
+                    return prog
+            return None
+
+
+def does_not_compile(input):
+    raise SyntaxError()
+
+
+class ProgramCache:
+    """
+    Compiled programs keyed by their source. Once there are more than max_size of them, the least recently used one is
+    evicted. Programs that do not compile are cached as well, so they are not recompiled every time they are tried.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.funcs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, prog):
+        return prog in self.funcs
+
+    def __len__(self):
+        return len(self.funcs)
+
+    def get(self, prog):
+        func = self.funcs.get(prog)
+        if func is not None:
+            self.hits += 1
+            self.funcs.move_to_end(prog)
+            return func
+        self.misses += 1
+        try:
+            func = eval(f"lambda input: {prog}")
+        except Exception:
+            func = does_not_compile
+        self.funcs[prog] = func
+        if self.max_size is not None and len(self.funcs) > self.max_size:
+            self.funcs.popitem(last=False)
+            self.evictions += 1
+        return func
+
+    def stats(self):
+        return {"size": len(self.funcs), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class Settings:
+    """
+    The config of a Synthesizer: the values it was given for entries of config.py, and the current values in config.py
+    of the other entries.
+    """
+
+    def __init__(self, **entries):
+        for name in entries:
+            if name.startswith("set_") or not hasattr(config, name):
+                raise TypeError(f"{name} is not a config entry")
+        self.__dict__.update(entries)
+
+    def __getattr__(self, name):  # only called for the entries it was not given
+        return getattr(config, name)
+
+
+class Synthesizer:
+    """
+    A synthesis session with its own caches, enumeration state, config and Z3 context, so sessions can run concurrently
+    in different threads. Calls from other threads wait for the running synthesis to finish.
+    """
+
+    def __init__(self, **config_entries):
+        self.config = Settings(**config_entries)
+        self.cache = ProgramCache(self.config.eval_cache_size)
+        self.semantic_functions = {}  # of the rules of the grammar of the last synthesis
+        self.z3_context = None  # of the session's provers, made on first use since Z3 contexts can't be shared
+        self.terms = TermStore(set())
+        self.examples = []  # the examples being enumerated on, which CEGIS adds to
+        self.prog_result_cache = {}  # term -> results vector on all the examples
+        self.partial_results = {}  # term -> PartialResults, until they are all known
+        self.prog_constant_cache = {}
+        self.seen_constants = {}  # nonterminal -> ConstantTable
+        self.equivalents = None  # nonterminal -> program -> the programs found equivalent to it, kept in CEGIS mode
+        self.provers = {}  # nonterminal -> Prover
+        self.pool = None  # the worker processes of a synthesis when config.workers is set
+        self.vectorizer = None  # the VectorizedEvaluator of the grammar being enumerated, if it has one
+        self.scheduler = ExampleScheduler(0)
+        self.evaluation_started = None  # when the candidate being evaluated started running, None when none is
+        self.killed = {"time": 0, "recursion": 0}  # evaluations of candidates killed for exceeding each limit
+        # counted over all syntheses of the session, for benchmarking (see benchmark.py)
+        self.candidates = []  # programs tried, by the height of the enumeration they were tried at
+        self.evaluations = 0  # of candidates on an input, in this process
+        self.oe_hits = 0  # programs found observationally equivalent to one seen before
+        self.stats = None  # the SynthesisStats of the running or last synthesis, when config.stats is set
+        self.enumerating = False  # whether a synthesis is running in it, see enumeration
+        self.lock = threading.RLock()  # reentrant for candidates synthesizing with the session running them
+
+    def do_synthesis(self, parsed, examples, timeout=60, trs=None, depth_limit=None, cancellation=None,
+                     strategy="bottom-up"):
+        return self.do_batch_synthesis(parsed, [examples], timeout=timeout, trs=trs, depth_limit=depth_limit,
+                                       cancellation=cancellation, strategy=strategy)[0]
+
+    def do_batch_synthesis(self, parsed, specs, timeout=60, trs=None, depth_limit=None, cancellation=None,
+                           strategy="bottom-up"):
+        with self.lock, self.running():
+            return do_batch_synthesis(parsed, specs, timeout=timeout, trs=trs, depth_limit=depth_limit,
+                                      cancellation=cancellation, strategy=strategy)
+
+    def synthesis_events(self, parsed, examples, timeout=60, trs=None, depth_limit=None, cancellation=None,
+                         strategy="bottom-up"):
+        # the events must all be generated in one thread, whose current session it is until the generator is done
+        with self.lock, self.running():
+            yield from synthesis_events(parsed, examples, timeout=timeout, trs=trs, depth_limit=depth_limit,
+                                        cancellation=cancellation, strategy=strategy)
+
+    @contextlib.contextmanager
+    def running(self):
+        """
+        Makes it the current session of this thread.
+        """
+        previous = getattr(local, "session", None)
+        local.session = self
+        try:
+            yield
+        finally:
+            if previous is None:
+                del local.session
+            else:
+                local.session = previous
+
+
+def current():
+    """
+    The Synthesizer of this thread: the one running in it, or else a session made for the thread on first use.
+    """
+    try:
+        return local.session
+    except AttributeError:
+        local.session = Synthesizer()
+        return local.session
+
+
+def __getattr__(name):
+    if name in SESSION_STATE:
+        return getattr(current(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def eval_cached(prog, input):
+    session = current()
+    return run_candidate(session, session.cache.get(prog), input)
+
+
+def run_candidate(session, func, *args):
+    """
+    func(*args) for a function built from a candidate, or NoResult if it fails or is killed for exceeding its budget
+    (see evaluation_budget).
+    """
+    session.evaluations += 1
     try:
-        if prog in cache:
-            return cache[prog](input)
-        func = eval(f"lambda input: {prog}")
-        cache[prog] = func
-        return func(input)
+        session.evaluation_started = time.perf_counter()
+        return func(*args)
+    except EvaluationTimeout:
+        session.killed["time"] += 1
+        return NoResult()
+    except RecursionError:
+        session.killed["recursion"] += 1
+        return NoResult()
     except:
         return NoResult()  # x s.t. x != x
+    finally:
+        session.evaluation_started = None
+
+
+def interrupt_candidate(signum, frame):
+    # the signal is handled in the innermost Python frame, which is the candidate's unless it is run_candidate's own
+    session = getattr(local, "session", None)
+    if session is not None and session.evaluation_started is not None and \
+            frame.f_code is not run_candidate.__code__ and \
+            time.perf_counter() - session.evaluation_started > session.config.eval_time_limit:
+        raise EvaluationTimeout()
+
+
+def start_evaluation_timer(time_limit):
+    """
+    Starts the timer checking the running candidate against time_limit, and returns a function stopping it and
+    restoring what it replaced, or None if signals can't be used here.
+    """
+    if time_limit is None or not hasattr(signal, "setitimer") or \
+            threading.current_thread() is not threading.main_thread():
+        return None
+    started = time.monotonic()
+    previous_handler = signal.signal(signal.SIGALRM, interrupt_candidate)
+    delay, interval = signal.setitimer(signal.ITIMER_REAL, time_limit / 4, time_limit / 4)
+
+    def stop():
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if delay:  # a timer of 0 is disarmed, so one that is overdue is restored with the least delay instead
+            signal.setitimer(signal.ITIMER_REAL, max(delay - (time.monotonic() - started), 1e-6), interval)
+
+    return stop
+
+
+@contextlib.contextmanager
+def evaluation_budget():
+    """
+    Within it, candidates exceeding config.eval_time_limit or config.eval_recursion_limit are killed and get NoResult.
+    This needs setitimer and the main thread.
+    """
+    session = current()
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    recursion_limit = sys.getrecursionlimit()
+    if session.config.eval_recursion_limit is not None:
+        depth, frame = 0, sys._getframe()
+        while frame is not None:
+            depth, frame = depth + 1, frame.f_back
+        sys.setrecursionlimit(depth + RECURSION_SLACK + session.config.eval_recursion_limit)
+    stop_timer = start_evaluation_timer(session.config.eval_time_limit)
+    try:
+        yield
+    finally:
+        if stop_timer is not None:
+            stop_timer()
+        sys.setrecursionlimit(recursion_limit)
+
+
+SEMANTICS_BLOCKING_REGEX = re.compile(r"\blambda\b|\bfor\b|['\".]")
+COMPOSABLE_TYPES = (int, float, complex, bool, str, bytes, type(None), range, types.FunctionType,
+                    types.BuiltinFunctionType)
+
+
+def semantic_function(rule, nonterminals):
+    """
+    A function computing the value of the rule's expansion from the input and the values of its nonterminals, or None
+    if substituting values for the nonterminals' sources could change its meaning.
+    """
+    session = current()
+    if rule in session.semantic_functions:
+        return session.semantic_functions[rule]
+    func = None
+    positions = [i for i, token in enumerate(rule.rhs) if token in nonterminals]
+    terminals = ''.join(token for token in rule.rhs if token not in nonterminals)
+    if positions and not SEMANTICS_BLOCKING_REGEX.search(terminals):
+        params = [f"_slacc_{i}" for i in range(len(positions))]
+        body = list(rule.rhs)
+        for i, param in zip(positions, params):
+            body[i] = param
+        before = [''.join(rule.rhs[:i]).rstrip()[-1:] for i in positions]
+        after = [''.join(rule.rhs[i + 1:]).lstrip()[:1] for i in positions]
+        if len(rule.rhs) == 1 or all(b and b in "([," and a and a in ")]," for b, a in zip(before, after)):
+            try:
+                func = eval(f"lambda input, {', '.join(params)}: {''.join(body)}")
+            except Exception:
+                func = None
+    session.semantic_functions[rule] = func
+    return func
+
+
+def composable(value):
+    """
+    Whether a stored value may be handed to a semantic function, which excludes iterators and other values that are
+    consumed or changed by being used.
+    """
+    if isinstance(value, COMPOSABLE_TYPES):
+        return True
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return all(composable(it) for it in value)
+    if isinstance(value, dict):
+        return all(composable(it) for it in value.values())
+    if isinstance(value, linked_list):
+        return composable(value.value) and composable(value.next)
+    return False
+
+
+def apply_semantics(func, prog, input, values):
+    session = current()
+    if all(composable(it) for it in values):
+        return run_candidate(session, func, input, *values)
+    return eval_cached(session.terms.string(prog), input)
+
+
+def get_semantics(prog):
+    session = current()
+    rule = session.terms.rules[prog]
+    if rule is None or not session.config.compose_results:
+        return None
+    return session.semantic_functions.get(rule)
+
+
+def results_vector(prog, examples):
+    """
+    The outputs of the term prog on the examples. When prog was derived using a rule with a semantic function, they
+    are composed from the outputs of its subexpressions instead of evaluating prog.
+    """
+    session = current()
+    results = session.prog_result_cache
+    if prog not in results and prog in session.partial_results:
+        for i in range(len(examples)):
+            result(prog, i, examples)
+    elif prog not in results:
+        func = get_semantics(prog)
+        if func is None:
+            source = session.terms.string(prog)
+            results[prog] = [eval_cached(source, k) for k, _ in examples]
+        else:
+            vectors = [results_vector(child, examples) for child in session.terms.children[prog]]
+            results[prog] = [apply_semantics(func, prog, k, [vector[i] for vector in vectors])
+                             for i, (k, _) in enumerate(examples)]
+    return results[prog]
+
+
+class PartialResults(list):
+    """
+    The results of a program on the examples it was evaluated on so far, with UNKNOWN for the others.
+    """
+
+    def __init__(self, size):
+        super().__init__([UNKNOWN] * size)
+        self.unknown = size
+
+
+def result(prog, i, examples):
+    """
+    The output of the term prog on the i-th example, composed like in results_vector when possible. Once a program's
+    results on all examples are known, they are its results vector.
+    """
+    session = current()
+    vector = session.prog_result_cache.get(prog)
+    if vector is not None:
+        return vector[i]
+    partial = session.partial_results.get(prog)
+    if partial is None:
+        partial = session.partial_results[prog] = PartialResults(len(examples))
+    value = partial[i]
+    if value is UNKNOWN:
+        func = get_semantics(prog)
+        if func is None:
+            value = eval_cached(session.terms.string(prog), examples[i][0])
+        else:
+            value = apply_semantics(func, prog, examples[i][0],
+                                    [result(child, i, examples) for child in session.terms.children[prog]])
+        partial[i] = value
+        partial.unknown -= 1
+        if not partial.unknown:
+            store_results(prog, list(partial))
+    return value
+
+
+def fails_on_an_example(prog):
+    """
+    Whether the term prog failed on one of the examples it was evaluated on so far.
+    """
+    session = current()
+    vector = session.prog_result_cache.get(prog)
+    if vector is None:
+        vector = session.partial_results.get(prog, ())
+    return type(vector) is not PlainResults and any(isinstance(it, NoResult) for it in vector)
+
+
+def store_results(prog, vector):
+    """
+    Stores the results vector of the term prog, which only has the results on the first examples if it was evaluated
+    before examples were added (e.g. by the workers, which only have the first ones).
+    """
+    session = current()
+    if len(vector) == len(session.examples):
+        session.prog_result_cache[prog] = vector
+        session.partial_results.pop(prog, None)
+        return
+    partial = session.partial_results.get(prog)
+    if partial is None:
+        partial = session.partial_results[prog] = PartialResults(len(session.examples))
+    for i, value in enumerate(vector):
+        if partial[i] is UNKNOWN:
+            partial[i] = value
+            partial.unknown -= 1
+
+
+def add_example(examples, example):
+    """
+    Adds example to the examples being enumerated on, so the results of every program are extended by one unknown
+    result, which is then computed when needed. The enumeration takes it into account from the next rule it applies.
+    """
+    session = current()
+    examples.append(example)
+    for prog, vector in session.prog_result_cache.items():
+        partial = session.partial_results[prog] = PartialResults(len(examples))
+        partial[:-1] = vector
+        partial.unknown = 1
+    session.prog_result_cache = {}
+    for partial in session.partial_results.values():
+        if len(partial) < len(examples):
+            partial.append(UNKNOWN)
+            partial.unknown += 1
+    session.scheduler.add_example()
+
+
+class ExampleScheduler:
+    """
+    The order to check examples in: the ones that rejected the most candidates per second spent on them first.
+    """
+
+    def __init__(self, count):
+        self.rejections = [0] * count
+        self.seconds = [0.0] * count
+        self.checks = 0
+        self.current = tuple(range(count))
+        self.subsets = {}  # indices -> the order of the examples with these indices
+
+    def order(self, indices=None):
+        """
+        The order of all examples, or of the ones with the given indices (a range or a tuple).
+        """
+        if indices is None:
+            return self.current
+        order = self.subsets.get(indices)
+        if order is None:
+            members = indices if isinstance(indices, range) else set(indices)
+            order = self.subsets[indices] = tuple(i for i in self.current if i in members)
+        return order
+
+    def add_example(self):
+        # an added example is a counterexample to a candidate, so it is likely to reject others as well
+        self.rejections.append(0)
+        self.seconds.append(0.0)
+        self.current = (len(self.current),) + self.current
+        self.subsets = {}
+
+    def record(self, i, seconds, rejected):
+        """
+        Records a check of a candidate on the i-th example, which took seconds and rejected it or not.
+        """
+        self.seconds[i] += seconds
+        self.rejections[i] += rejected
+        self.checks += 1
+        if not self.checks % SCHEDULING_INTERVAL:
+            # the rejections are counted from one, so examples are tried again after being slow once
+            self.current = tuple(sorted(range(len(self.current)),
+                                        key=lambda it: -(self.rejections[it] + 1) / (self.seconds[it] + 1e-9)))
+            self.subsets = {}
+
+
+def constant_value(prog):
+    """
+    The value of the term prog when input is None, composed like in results_vector when possible.
+    """
+    session = current()
+    constants = session.prog_constant_cache
+    if prog not in constants:
+        func = get_semantics(prog)
+        if func is None:
+            constants[prog] = eval_cached(session.terms.string(prog), None)
+        else:
+            constants[prog] = apply_semantics(func, prog, None,
+                                              [constant_value(it) for it in session.terms.children[prog]])
+    return constants[prog]
+
+
+class Prover:
+    """
+    A Z3 solver for proving programs of one nonterminal equivalent, with the encoding of every program built once.
+    Only programs Z3 models exactly are encoded (see exactly_encodable).
+    """
+
+    def __init__(self):
+        session = current()
+        if session.z3_context is None:
+            session.z3_context = Context()
+        context = session.z3_context
+        self.solver = Solver(ctx=context)
+        if session.config.proof_timeout:
+            self.solver.set("timeout", session.config.proof_timeout)
+        self.terms = session.terms
+        self.input = {"input": Int("input", context)}
+        self.variables = {it: Int(it, context) for it in ["x", "y", "z", "w", "n"]}
+        self.encodings = {}  # (term, whether input is symbolic rather than the variables) -> value, or None
+        self.samples = {}  # (term, whether input is symbolic) -> its values at PROOF_SAMPLES, see equivalent
+
+    def encoding(self, prog, symbolic_input=True):
+        key = (prog, symbolic_input)
+        if key not in self.encodings:
+            source = self.terms.string(prog)
+            names = self.input if symbolic_input else self.variables
+            value = sample = None
+            if exactly_encodable(source, names):
+                try:
+                    value = eval(source, {"__builtins__": {}}, names)
+                    sample = tuple(eval(source, {"__builtins__": {}}, dict(zip(names, it))) for it in PROOF_SAMPLES)
+                except (Z3Exception, TypeError):
+                    value = None
+            self.encodings[key], self.samples[key] = value, sample
+        return self.encodings[key]
+
+    def check(self, *constraints):
+        self.solver.push()
+        try:
+            self.solver.add(*constraints)
+            return self.solver.check()
+        finally:
+            self.solver.pop()
+
+    def equivalent(self, prog, other, symbolic_input=True):
+        """
+        Whether prog and other provably have the same value for every input (or every value of the variables).
+        """
+        value, other_value = self.encoding(prog, symbolic_input), self.encoding(other, symbolic_input)
+        if value is None or other_value is None or \
+                self.samples[prog, symbolic_input] != self.samples[other, symbolic_input]:
+            return False  # programs differing at a sample point are told apart without asking Z3
+        try:
+            difference = value != other_value
+        except Z3Exception:
+            return False
+        if not isinstance(difference, BoolRef):
+            return not difference
+        return self.check(difference) == unsat
+
+    def equivalent_to_any(self, prog, seen_progs):
+        """
+        Whether prog, which uses the variables rather than input, provably equals one of seen_progs.
+        """
+        if self.encoding(prog, False) is None:
+            return False
+        return any(self.equivalent(prog, it, False) for it in seen_progs)
+
+
+PROOF_SAMPLES = [(-3, 5, 0, 2, -1), (0, 1, -2, 7, 3), (4, -6, 1, -1, 10)]  # values of input, or of x, y, z, w and n
+# the nodes of expressions whose Python semantics Z3 models exactly on Ints: / and // round differently, for example
+EXACT_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Load, ast.Constant, ast.Add,
+               ast.Sub, ast.Mult, ast.USub, ast.UAdd, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+
+def exactly_encodable(source, names):
+    """
+    Whether source only applies +, -, * and single comparisons to integers and the given names.
+    """
+    try:
+        tree = ast.parse(source.strip(), mode="eval")
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if not isinstance(node, EXACT_NODES) or isinstance(node, ast.Name) and node.id not in names or \
+                isinstance(node, ast.Constant) and type(node.value) is not int or \
+                isinstance(node, ast.Compare) and len(node.ops) > 1:
+            return False
+    return True
+
+
+def unbound_names(prog):
+    """
+    The names the term prog loads without binding them, that are not builtins or names of this module either, such as
+    the variables of a lambda it is the body of. Evaluating prog raises NameError when it gets to one of them.
+    """
+    session = current()
+    func = session.cache.get(session.terms.string(prog))
+    names = set()
+    codes = [func.__code__] if func is not does_not_compile else []
+    while codes:
+        code = codes.pop()
+        names.update(it.argval for it in dis.get_instructions(code) if it.opname in ("LOAD_GLOBAL", "LOAD_NAME"))
+        codes.extend(it for it in code.co_consts if isinstance(it, types.CodeType))
+    return {it for it in names if it not in globals() and not hasattr(builtins, it)}
+
+
+def get_prover(seen_progs):
+    session = current()
+    if seen_progs.nonterminal not in session.provers:
+        session.provers[seen_progs.nonterminal] = Prover()
+    return session.provers[seen_progs.nonterminal]
+
+
+def init_worker(eval_cache_size, eval_time_limit, inputs):
+    global worker_inputs
+    session = current()
+    session.config = Settings(eval_time_limit=eval_time_limit)
+    session.cache = ProgramCache(eval_cache_size)
+    worker_inputs = inputs
+    start_evaluation_timer(eval_time_limit)
+
+
+def portable(value):
+    """
+    value pickled, or None if it can't be sent back from a worker (e.g. functions and iterators).
+    """
+    try:
+        return pickle.dumps(value)
+    except:
+        return None
+
+
+def evaluate_in_worker(task):
+    """
+    Evaluates a source in a worker process. Returns its pickled constant value and results vector (each if requested
+    and portable, otherwise None).
+    """
+    source, constant, results = task
+    return (portable(eval_cached(source, None)) if constant else None,
+            portable([eval_cached(source, k) for k in worker_inputs]) if results else None)
+
+
+def prefetch(values, constants, results):
+    """
+    Passes the terms generated by values through, evaluating the constants and results vectors they will need in
+    chunks first when there is a worker pool or a vectorizer.
+    """
+    session = current()
+    if not (session.pool is not None and (constants or results) or session.vectorizer is not None and results):
+        yield from values
+        return
+    while True:
+        chunk = list(itertools.islice(values, PARALLEL_CHUNK_SIZE))
+        if not chunk:
+            return
+        if session.vectorizer is not None and results:
+            vectorize_results(chunk)
+        if session.pool is None:
+            yield from chunk
+            continue
+        tasks = []
+        for term in chunk:
+            if get_semantics(term) is not None:
+                continue
+            task = (session.terms.string(term), constants and term not in session.prog_constant_cache,
+                    results and term not in session.prog_result_cache)
+            if task[1] or task[2]:
+                tasks.append((term, task))
+        outputs = session.pool.map(evaluate_in_worker, [task for _, task in tasks],
+                                   chunksize=max(1, len(tasks) // (4 * session.config.workers)))
+        for (term, _), (constant, vector) in zip(tasks, outputs):
+            if constant is not None:
+                session.prog_constant_cache[term] = pickle.loads(constant)
+            if vector is not None:
+                store_results(term, pickle.loads(vector))
+        yield from chunk
+
+
+def vectorize_results(chunk):
+    """
+    Puts the results vectors of the terms in chunk that the vectorizer can evaluate in prog_result_cache.
+    """
+    session = current()
+    chunk = [term for term in chunk if term not in session.prog_result_cache and get_semantics(term) is None]
+    vectors = session.vectorizer.evaluate([session.terms.string(term) for term in chunk], NoResult)
+    for term, vector in zip(chunk, vectors):
+        if vector is not None:
+            store_results(term, vector)
 
 
 def debug(*args):
-    if config.debug:
+    if current().config.debug:
         print(*args)
 
 
-def do_synthesis(parsed, examples, timeout=60, trs=None, depth_limit=None):
+def do_synthesis(parsed, examples, timeout=60, trs=None, depth_limit=None, cancellation=None, strategy="bottom-up"):
+    """
+    Synthesize a program from a list of expressions and examples, or None on timeout or cancellation.
+    strategy is one of STRATEGIES (see enumeration).
+    """
+    return do_batch_synthesis(parsed, [examples], timeout=timeout, trs=trs, depth_limit=depth_limit,
+                              cancellation=cancellation, strategy=strategy)[0]
+
+
+def do_batch_synthesis(parsed, specs, timeout=60, trs=None, depth_limit=None, cancellation=None,
+                       strategy="bottom-up"):
+    """
+    Synthesize a program for each list of examples in specs (None for the unsolved ones), enumerating the grammar once
+    for all of them.
+    """
+    rules, nonterminals = parsed
+    solutions = [None] * len(specs)
+    if not specs:
+        return solutions
+    working = WorkingExamples(specs, current().config.cegis_examples)
+    pending = list(range(len(specs)))
+
+    debug(f"DEBUG: {len(rules)} rules, {len(nonterminals)} nonterminals, {len(specs)} specifications")
+
+    with enumeration(parsed, working.examples, timeout, trs, depth_limit, cancellation,
+                     cegis=working.cegis, strategy=strategy) as programs:
+        for prog in programs:
+            for i in list(pending):
+                if working.consistent(prog, i):
+                    if len(specs) > 1:
+                        debug(f"DEBUG: found {prog} for specification {i}")
+                    else:
+                        debug("DEBUG: found", prog)
+                    debug_stats()
+                    solutions[i] = prog
+                    pending.remove(i)
+            if not pending:
+                break
+    return solutions
+
+
+HeightDone = namedtuple("HeightDone", ["height", "counts"])  # counts maps each nonterminal to its number of instances
+Solution = namedtuple("Solution", ["program"])
+
+
+def synthesis_events(parsed, examples, timeout=60, trs=None, depth_limit=None, cancellation=None,
+                     strategy="bottom-up"):
     """
-    Synthesize a program from a list of expressions and examples.
+    Like do_synthesis, but generates a HeightDone whenever a height is enumerated and a Solution for every consistent
+    program, until the generator is closed, on timeout or on cancellation.
     """
     rules, nonterminals = parsed
+    debug(f"DEBUG: {len(rules)} rules, {len(nonterminals)} nonterminals, streaming solutions")
+    working = WorkingExamples([examples], current().config.cegis_examples)
+    events = []
+    with enumeration(parsed, working.examples, timeout, trs, depth_limit, cancellation,
+                     lambda height, counts: events.append(HeightDone(height, counts)), working.cegis,
+                     strategy) as programs:
+        for prog in programs:
+            yield from events
+            events.clear()
+            if prog is not None and working.consistent(prog, 0):
+                debug("DEBUG: found", prog)
+                yield Solution(prog)
+        yield from events
 
-    global cache
-    cache = {}
-    global prog_result_cache
-    prog_result_cache = {}
-    global seen_constants
-    seen_constants = set_used()
 
-    debug(f"DEBUG: {len(rules)} rules, {len(nonterminals)} nonterminals")
+async def stream_synthesis(parsed, examples, timeout=60, trs=None, depth_limit=None, max_solutions=None,
+                           session=None, executor=None, strategy="bottom-up"):
+    """
+    Asynchronously generates the events of synthesis_events, run in executor, stopping after max_solutions solutions
+    unless it is None. Closing the generator cancels the synthesis.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancellation = CancellationToken()
+    finished = object()
 
-    g = expand(rules, "PROGRAM", nonterminals, examples=examples, trs=trs, depth_limit=depth_limit)
-    start_time = time.time()
-    while timeout < 0 or time.time() - start_time < timeout:
+    def produce():
         try:
-            prog = next(g)
-            debug("DEBUG: trying", prog)
-        except StopIteration:
-            debug("DEBUG: ran out of possible programs or reached depth limit")
-            return None
-        if all(eval_cached(prog, item[0]) == item[1] for item in examples):
-            debug("DEBUG: found", prog)
-            return prog
-    debug("DEBUG: timeout")
-    return None
+            source = session.synthesis_events if session is not None else synthesis_events
+            for event in source(parsed, examples, timeout, trs, depth_limit, cancellation, strategy):
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, finished)
+
+    producer = loop.run_in_executor(executor, produce)
+    solutions = 0
+    try:
+        while max_solutions is None or solutions < max_solutions:
+            event = await queue.get()
+            if event is finished:
+                break
+            if isinstance(event, Exception):
+                raise event
+            if isinstance(event, Solution):
+                solutions += 1
+            yield event
+    finally:
+        cancellation.cancel()
+        await producer
+
+
+@contextlib.contextmanager
+def enumeration(parsed, examples, timeout, trs, depth_limit, cancellation, progress=None, cegis=False,
+                strategy="bottom-up"):
+    """
+    Sets the current session up for enumerating the programs of parsed with the given strategy, and gives a generator of
+    them. It also gives None after every call to progress, so heights are reported without waiting for a program.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"unknown enumeration strategy {strategy!r}, expected one of {', '.join(STRATEGIES)}")
+    session = current()
+    if session.enumerating:
+        with Synthesizer(**vars(session.config)).running(), \
+                enumeration(parsed, examples, timeout, trs, depth_limit, cancellation, progress, cegis,
+                            strategy) as programs:
+            yield programs
+        return
+    grammar = syntax.Grammar(*parsed)
+    rules, nonterminals = grammar
+    if session.cache.max_size != session.config.eval_cache_size:
+        session.cache = ProgramCache(session.config.eval_cache_size)
+    session.killed = {"time": 0, "recursion": 0}
+    stats = session.stats = SynthesisStats(session.config.profile) \
+        if session.config.stats or session.config.profile else None
+    tracing = session.config.debug
+
+    cancellation = CancellationToken(timeout, cancellation)
+    tried = counted = 0  # programs generated, and those of them already counted by height
+    height = 0
+
+    def height_done(done, counts):
+        nonlocal height
+        count_candidates(done)
+        if stats is not None:
+            stats.height_done(done)
+        height = done + 1
+        if progress is not None:
+            progress(done, counts)
+
+    def count_candidates(done):
+        nonlocal counted
+        while len(session.candidates) <= done:
+            session.candidates.append(0)
+        session.candidates[done] += tried - counted
+        counted = tried
+
+    start_enumeration(grammar, examples, cegis)
+    if strategy == "bottom-up":
+        g = expand(rules, "PROGRAM", nonterminals, examples=examples, trs=trs, depth_limit=depth_limit,
+                   cancellation=cancellation, progress=height_done, cegis=cegis)
+    elif strategy == "top-down":
+        g = expand_top_down(grammar, examples, trs, depth_limit, cancellation, progress=height_done, cegis=cegis)
+    else:  # the progress of the bottom-up enumeration, whose heights are more telling
+        g = alternate(expand(rules, "PROGRAM", nonterminals, examples=examples, trs=trs, depth_limit=depth_limit,
+                             cancellation=cancellation, progress=height_done, cegis=cegis, cached=False),
+                      expand_top_down(grammar, examples, trs, depth_limit, cancellation, cegis=cegis))
+
+    def programs():
+        nonlocal tried
+        while True:
+            try:
+                cancellation.check()
+                prog = next(g)
+                if prog is not None and tracing:
+                    debug("DEBUG: trying", prog)
+            except Cancelled:
+                debug("DEBUG: cancelled" if cancellation.parent is not None and cancellation.parent.expired()
+                      else "DEBUG: timeout")
+                return
+            except StopIteration:
+                debug("DEBUG: ran out of possible programs or reached depth limit")
+                return
+            if prog is None:  # a height is done
+                if progress is not None:
+                    yield None
+                continue
+            tried += 1
+            if stats is not None:
+                stats.height(height).candidates += 1
+            yield prog
+
+    session.enumerating = True
+    try:
+        if session.config.workers:
+            session.pool = multiprocessing.Pool(session.config.workers, initializer=init_worker,
+                                                initargs=(session.config.eval_cache_size,
+                                                          session.config.eval_time_limit, [k for k, _ in examples]))
+        with evaluation_budget():
+            yield programs()
+    finally:
+        session.enumerating = False
+        if tried > counted:
+            count_candidates(height)  # of the height the enumeration stopped in
+        if stats is not None and len(stats.heights) > height:
+            stats.height_done(height)
+        if session.pool is not None:
+            g.close()
+            session.pool.terminate()
+            session.pool = None
+
+
+def satisfies(prog, examples, indices=None):
+    """
+    Whether the program prog is consistent with the examples (only the ones with the given indices, a range or a tuple,
+    unless it is None), checking them in the scheduler's order and evaluating it on as few of them as it takes.
+    """
+    session = current()
+    term = session.terms.find(prog)  # None for sources rewritten by term rewriting rules
+    for i in session.scheduler.order(indices):
+        started = time.perf_counter()
+        out = eval_cached(prog, examples[i][0]) if term is None else result(term, i, examples)
+        correct = out == examples[i][1]
+        session.scheduler.record(i, time.perf_counter() - started, not correct)
+        if not correct:
+            return False
+    return True
+
+
+class WorkingExamples:
+    """
+    The examples a synthesis enumerates with, and the specs they come from. In CEGIS mode only the first size examples
+    of each spec are used at first, and the others are added as counterexamples (see consistent).
+    """
+
+    def __init__(self, specs, size=None):
+        self.cegis = bool(size) and any(len(spec) > size for spec in specs)
+        self.examples, self.indices, self.unused = [], [], []
+        for spec in specs:
+            used = spec[:size] if self.cegis else spec
+            self.indices.append(range(len(self.examples), len(self.examples) + len(used)))
+            self.examples.extend(used)
+            self.unused.append(list(spec[len(used):]))
+
+    def consistent(self, prog, i):
+        """
+        Whether prog is consistent with the i-th spec, adding the first counterexample it has to the examples.
+        """
+        if not satisfies(prog, self.examples, self.indices[i]):
+            return False
+        for j, (k, v) in enumerate(self.unused[i]):
+            if eval_cached(prog, k) != v:
+                debug(f"DEBUG: {prog} fails on input {k!r}, adding it to the examples")
+                add_example(self.examples, self.unused[i].pop(j))
+                self.indices[i] = tuple(self.indices[i]) + (len(self.examples) - 1,)
+                return False
+        return True
+
+
+def debug_stats():
+    session = current()
+    debug(f"DEBUG: compiled program cache: {session.cache.stats()}")
+    debug(f"DEBUG: killed evaluations: {session.killed['time']} over time, {session.killed['recursion']} too deep")
 
 
 def check_if_function(prog_to_test):
+    session = current()
+    terms = session.terms
     try:
-        if callable(eval_cached(prog_to_test, None)):
-            debug(f"DEBUG: {prog_to_test} is a function and therefore observational equivalence is undecidable")
+        if callable(constant_value(prog_to_test)):
+            if session.config.debug:
+                debug(f"DEBUG: {terms.string(prog_to_test)} is a function and therefore observational equivalence is"
+                      f" undecidable")
             return True
     except:
         pass
@@ -107,39 +1284,46 @@ def check_if_function(prog_to_test):
 
 
 def check_if_seen_constant(prog_to_test, seen_progs):
-    if "input" not in prog_to_test:  # heuristic. constants in general are undecidable
-        debug(f"DEBUG: {prog_to_test} does not contain input. Checking if it is a constant...")
+    session = current()
+    terms = session.terms
+    if not terms.inputs[prog_to_test]:  # heuristic. constants in general are undecidable
+        if session.config.debug:
+            debug(f"DEBUG: {terms.string(prog_to_test)} does not contain input. Checking if it is a constant...")
         try:
-            const = eval_cached(prog_to_test, None)
+            const = constant_value(prog_to_test)
+            if type(const) == NoResult and session.config.prove and unbound_names(prog_to_test):
+                raise NameError()  # it uses variables bound outside of it, so it is not a constant
             if callable(const) or type(const) == NoResult:
-                debug(f"DEBUG: {prog_to_test} is not necessarily a constant and therefore observational equivalence"
-                      f" is undecidable")
+                if session.config.debug:
+                    debug(f"DEBUG: {terms.string(prog_to_test)} is not necessarily a constant and therefore"
+                          f" observational equivalence is undecidable")
                 return ConstantResult.UNDECIDABLE_CONSTANT
-            debug(f"DEBUG: {prog_to_test} is a constant. Checking if any other are the same constant...")
-            for prog in seen_constants:
-                if eval_cached(prog, None) == const:
-                    debug(f"DEBUG: {prog_to_test} is equivalent to {prog} because they are the same constant")
-                    return ConstantResult.SEEN_CONSTANT
-            debug(f"DEBUG: {prog_to_test} is a not-yet seen constant")
+            if session.config.debug:
+                debug(f"DEBUG: {terms.string(prog_to_test)} is a constant. Checking if any other are the same"
+                      f" constant...")
+            prog = seen_progs.constants.find(const)
+            if prog is not None:
+                if session.config.debug:
+                    debug(f"DEBUG: {terms.string(prog_to_test)} is equivalent to {terms.string(prog)} because"
+                          f" they are the same constant")
+                return ConstantResult.SEEN_CONSTANT
+            if session.config.debug:
+                debug(f"DEBUG: {terms.string(prog_to_test)} is a not-yet seen constant")
             return ConstantResult.NOT_SEEN_CONSTANT
         except NameError:
             # try proving
-            debug(f"DEBUG: {prog_to_test} is not a constant. Trying to prove it's equal to any other program...")
+            if session.config.debug:
+                debug(f"DEBUG: {terms.string(prog_to_test)} is not a constant. Trying to prove it's equal to any other"
+                      f" program...")
             try:
-                s = Solver()
-                x, y, z, w, n = Int('x'), Int('y'), Int('z'), Int('w'), Int('n')
-                for prog in seen_progs:
-                    try:
-                        s.add(Exists([x, y, z, w, n], eval_cached(prog_to_test, None) != eval_cached(prog, None)))
-                    except:
-                        pass
-                status = s.check()
-                if status != sat:
-                    debug(f"DEBUG: {prog_to_test} is equivalent to another program provably")
+                if get_prover(seen_progs).equivalent_to_any(prog_to_test, seen_progs):
+                    if session.config.debug:
+                        debug(f"DEBUG: {terms.string(prog_to_test)} is equivalent to another program provably")
                     return ConstantResult.SEEN_NOT_A_CONSTANT
             except Z3Exception:
                 return ConstantResult.UNDECIDABLE_NOT_A_CONSTANT  # not much we can do
-            debug(f"DEBUG: {prog_to_test} is not provably equivalent to another program.")
+            if session.config.debug:
+                debug(f"DEBUG: {terms.string(prog_to_test)} is not provably equivalent to another program.")
             return ConstantResult.NOT_SEEN_NOT_A_CONSTANT
         except:
             return ConstantResult.UNDECIDABLE_NOT_A_CONSTANT  # not much we can do
@@ -147,118 +1331,198 @@ def check_if_seen_constant(prog_to_test, seen_progs):
 
 
 def equiv_to_any(seen_progs, prog_to_test, examples):
-    debug(f"DEBUG: checking for equivalence with {prog_to_test}...")
+    """
+    Whether the term prog_to_test is equivalent to any of seen_progs, an ObservationalEquivalenceTable. The outcome is
+    counted in session.stats.
+    """
+    session = current()
+    terms = session.terms
+    stats = session.stats
+    if session.config.debug:
+        debug(f"DEBUG: checking for equivalence with {terms.string(prog_to_test)}...")
     if check_if_function(prog_to_test):
+        if stats is not None:
+            stats.outcome("FUNCTION")
         return False  # function equivalence is undecidable
 
     if prog_to_test in seen_progs:
-        debug(f"DEBUG: {prog_to_test} is in seen_progs")
+        if session.config.debug:
+            debug(f"DEBUG: {terms.string(prog_to_test)} is in seen_progs")
+        if stats is not None:
+            stats.outcome("SEEN")
         return True
 
     res = check_if_seen_constant(prog_to_test, seen_progs)
+    if res != ConstantResult.UNDECIDABLE_NOT_A_CONSTANT and stats is not None:
+        stats.outcome(res.name)
     if res == ConstantResult.SEEN_CONSTANT or res == ConstantResult.SEEN_NOT_A_CONSTANT:
         return True
     if res == ConstantResult.NOT_SEEN_CONSTANT or res == ConstantResult.NOT_SEEN_NOT_A_CONSTANT or \
             res == ConstantResult.UNDECIDABLE_CONSTANT:
-        seen_constants.add(prog_to_test)
+        seen_progs.constants.add(prog_to_test)
         return False
 
-    if config.prove:
+    if session.config.prove:
+        prover = get_prover(seen_progs)
         for prog in seen_progs:
-            s = Solver()
-            input = Int('input')
-            s.add(ForAll([input], eval_cached(prog, input) == eval_cached(prog_to_test, input)))
-            status = s.check()
-            if status == sat:
-                debug(f"DEBUG: {prog_to_test} is equivalent to {prog} provably")
+            if prover.equivalent(prog, prog_to_test):
+                if session.config.debug:
+                    debug(f"DEBUG: {terms.string(prog_to_test)} is equivalent to {terms.string(prog)} provably")
+                if stats is not None:
+                    stats.outcome("PROVABLY_EQUIVALENT")
                 return True
     else:
-        try:
-            x_outs = [eval_cached(prog_to_test, k) for k, _ in examples]
-        except NameError:
-            return False
-        for prog in seen_progs:
-            if prog in prog_result_cache:
-                results_vector = prog_result_cache[prog]
-            else:
-                results_vector = [eval_cached(prog, k) for k, _ in examples]
-                prog_result_cache[prog] = results_vector
-            if x_outs == results_vector:
-                debug(f"DEBUG: {prog_to_test} exhibits observational equivalence with {prog}")
-                prog_result_cache[prog_to_test] = prog_result_cache[prog]
-                return True
+        prog = seen_progs.find(prog_to_test)
+        if prog is not None:
+            if session.config.debug:
+                debug(f"DEBUG: {terms.string(prog_to_test)} exhibits observational equivalence with"
+                      f" {terms.string(prog)}")
+            store_results(prog_to_test, results_vector(prog, examples))
+            session.oe_hits += 1
+            if session.equivalents is not None:
+                session.equivalents[seen_progs.nonterminal].setdefault(prog, []).append(prog_to_test)
+            if stats is not None:
+                stats.outcome("OBSERVATIONALLY_EQUIVALENT")
+            return True
+    if stats is not None:
+        stats.outcome("NOT_EQUIVALENT")
     return False
 
 
-def get_ground_exprs(initial, rules, nonterminals) -> set_used:
+def get_ground_exprs(initial, grammar) -> set_used:
     ret = set_used()
-    temp = set_used([initial])
-    changed = True
-    while changed:
-        changed = False
-        for rule in rules:
-            nonterms = len([x for x in rule.rhs if x in nonterminals])
-            if nonterms not in [0, 1] or (len(rule.rhs) != 1 and any(it in nonterminals for it in rule.rhs)):
-                continue
-            if rule.lhs in temp:
-                if ''.join(rule.rhs) not in nonterminals and tuple(rule.rhs) not in ret:
-                    ret.add(tuple(rule.rhs))
-                    changed = True
-                elif ''.join(rule.rhs) not in temp:
-                    temp.add(''.join(rule.rhs))
-                    changed = True
+    for nonterminal in [initial] + grammar.units[initial]:
+        for rule in grammar.rules_by_lhs[nonterminal]:
+            if not grammar.arity(rule):
+                ret.add(tuple(rule.rhs))
     return ret
 
 
-def clean_instances(instances, nonterminals, examples):
+def build_oe_tables(instances_joined, nonterminals, examples):
+    tables = {it: ObservationalEquivalenceTable(examples, it) for it in nonterminals}
+    for k in nonterminals:
+        for joined, term in instances_joined[k].items():
+            tables[k].add(term, joined)
+    return tables
+
+
+def split_equivalents(tables, examples):
+    """
+    Extends the OE tables to the examples added since they were made, and adds the programs found equivalent to others
+    that these examples tell apart from them. Returns the added programs by nonterminal.
+    """
+    session = current()
+    revived = {}
+    for k, table in tables.items():
+        table.add_examples()
+        classes, session.equivalents[k] = session.equivalents[k], {}
+        revived[k] = []
+        for equivalents in classes.values():
+            for prog in equivalents:
+                if prog in table:
+                    continue
+                other = table.find(prog)
+                if other is None:
+                    table.add(prog)
+                    revived[k].append(prog)
+                else:
+                    session.equivalents[k].setdefault(other, []).append(prog)
+        if revived[k]:
+            debug(f"DEBUG: {len(revived[k])} programs of {k} are no longer equivalent to others")
+    return revived
+
+
+def clean_instances(instances, instances_joined, nonterminals, examples, cancellation=None):
+    # Returns the instances without equivalent ones, what they are joined by, and their OE tables, which expand then
+    # keeps up to date as instances are added (see add_instances).
     debug("DEBUG: Reached threshold for observational equivalence, cleaning instances set...")
     ret = {it: set_used() for it in nonterminals}
-    ret_joined = {it: set_used() for it in nonterminals}
+    tables = {it: ObservationalEquivalenceTable(examples, it) for it in nonterminals}
     for k in nonterminals:
-        for v in instances[k]:
-            if not equiv_to_any(ret_joined[k], ''.join(v), examples):
-                ret[k].add(v)
-                ret_joined[k].add(''.join(v))
-    return ret, ret_joined
-
-
-def get_values(rule, instances, nonterminals):
-    ret = [()]
-    for token in rule.rhs:
-        if token not in nonterminals:
-            ret = [item + (token,) for item in ret]
-        else:
-            newret = []
-            options = instances[token]
-            for option in options:
-                newret.extend([item + option for item in ret])
-            ret = newret
-    return set_used(ret) - instances[rule.lhs]
+        keys = {term: joined for joined, term in instances_joined[k].items()}
+        for term in instances[k]:
+            if cancellation is not None:
+                cancellation.check()
+            if not equiv_to_any(tables[k], term, examples):
+                ret[k].add(term)
+                tables[k].add(term, keys.get(term))
+    joined = {it: {key: term for key, term in instances_joined[it].items() if term in ret[it]} for it in nonterminals}
+    return ret, joined, tables
 
 
-def short_circuit(new_values, nonterminals, rules):
-    extra = {it: set_used() for it in nonterminals}
-    changed = True
-    while changed:
-        changed = False
-        for rule in rules:
-            nonterminals = [x for x in rule.rhs if x in nonterminals]
-            if len(nonterminals) != 1 \
-                    or rule.rhs[0] not in nonterminals:
-                continue
-            nonterminal = nonterminals[0]
-            if not new_values[nonterminal]:
+def get_values(rule, instances, grammar, frontier=None, rewriting=None, cancellation=None):
+    """
+    Generates the new terms built by applying the rule to the instances of its nonterminals, only the ones with a child
+    from frontier if it is given (in the same order), and in normal form if rewriting is given.
+    """
+    session = current()
+    terms = session.terms
+    tokens = grammar.arguments[rule]
+    options = [instances[token] for token in reversed(tokens)]
+    if frontier is None:
+        products = itertools.product(*options)
+    else:
+        products = frontier_product(options, [frontier[token] for token in reversed(tokens)])
+    seen = set()
+    built = 0
+    for children in products:
+        built += 1
+        if cancellation is not None and not built % CANCELLATION_CHECK_INTERVAL:
+            cancellation.check()
+        if rewriting:
+            term = rewriting.rewrite(terms, rule, children[::-1])
+        else:
+            term = terms.make(rule, children[::-1])
+        if term not in seen:
+            seen.add(term)
+            if term not in instances[rule.lhs]:
+                yield term
                 continue
-            old_len = len(extra[rule.lhs])
+        if rewriting and tokens and session.stats is not None:
+            session.stats.rule(rule).pruned_trs += 1
 
-            extra[rule.lhs].update(new_values[rule.rhs[0]])
-            if old_len != len(extra[rule.lhs]):
-                changed = True
-                debug(f"DEBUG: {len(extra[rule.lhs]) - old_len} elements short-circuited using rule {rule}")
+
+def frontier_product(options, frontier):
+    """
+    The tuples of itertools.product(*options) with at least one item from the matching set of frontier, in the same
+    order.
+    """
+    if not options:
+        return
+    last = options[-1]
+    start = min(map(last.index, frontier[-1]), default=len(last))
+    newest = [(item,) for item in last[start:] if item in frontier[-1]]
+
+    def tuples(i):
+        if i == len(options) - 1:
+            yield from newest
+            return
+        rest = options[i + 1:]
+        for item in options[i]:
+            if item in frontier[i]:
+                for others in itertools.product(*rest):
+                    yield (item,) + others
+            else:
+                for others in tuples(i + 1):
+                    yield (item,) + others
+
+    yield from tuples(0)
+
+
+def short_circuit(new_values, grammar):
+    extra = {it: set_used() for it in grammar.nonterminals}
+    for nonterminal, units in grammar.units.items():
+        for it in units:
+            if new_values[it]:
+                extra[nonterminal].update(new_values[it])
+                if current().config.debug:
+                    debug(f"DEBUG: {len(new_values[it])} elements of {it} short-circuited to {nonterminal}")
     return extra
 
 
 def apply_trs(string, trs):
+    if isinstance(trs, syntax.TermRewritingSystem):
+        return trs.normalize(string)
     changed = True
     while changed:
         changed = False
@@ -269,81 +1533,382 @@ def apply_trs(string, trs):
     return string
 
 
-def expand(rules: List[CfgRule], initial, nonterminals, examples, trs, depth_limit):
+def program_source(term, trs):
+    session = current()
+    source = session.terms.string(term)
+    if trs:
+        source = apply_trs(source, trs)
+    return source
+
+
+def instance_key(term, trs):
+    """
+    What instances are joined by: the source of term after the term rewriting rules trs, or the term itself without
+    them (the TermStore gives every source one term).
+    """
+    if trs:
+        return apply_trs(current().terms.string(term), trs)
+    return term
+
+
+def add_instances(instances, instances_joined, new_instances, oe_tables=None):
+    """
+    Adds the (term, key) pairs of new_instances to the instances of each nonterminal, and to their OE tables if
+    oe_tables is given, and returns the added terms by nonterminal.
+    """
+    added = {}
+    for k, pairs in new_instances.items():
+        for val, joined in pairs:
+            instances_joined[k].setdefault(joined, val)
+            if oe_tables is not None:
+                oe_tables[k].add(val, joined)
+        added[k] = set_used(val for val, _ in pairs)
+        instances[k] |= added[k]
+    return added
+
+
+def start_enumeration(grammar, examples, cegis=False):
+    """
+    Resets the state of the current session for enumerating the programs of grammar (a syntax.Grammar) on the
+    examples, keeping the programs found equivalent to others if cegis is set (see expand).
+    """
+    session = current()
+    config = session.config
+    rules, nonterminals = grammar
+    session.vectorizer = get_vectorized_evaluator(rules, nonterminals, [k for k, _ in examples]) \
+        if config.vectorize else None
+    if session.vectorizer is not None:
+        debug("DEBUG: evaluating programs on all examples at once")
+    session.terms = TermStore(nonterminals, config.term_string_cache_size)
+    session.provers = {}
+    session.examples = examples
+    session.prog_result_cache = {}
+    session.partial_results = {}
+    session.scheduler = ExampleScheduler(len(examples))
+    session.prog_constant_cache = {}
+    session.seen_constants = {it: ConstantTable() for it in nonterminals}
+    session.equivalents = {it: {} for it in nonterminals} if cegis else None
+    session.semantic_functions = {rule: session.semantic_functions[rule] for rule in rules
+                                  if rule in session.semantic_functions}
+    for rule in rules:
+        semantic_function(rule, nonterminals)
+
+
+def expand(rules: List[CfgRule], initial, nonterminals, examples, trs, depth_limit, cancellation=None, progress=None,
+           cegis=False, cached=True):
     # Bottom-Up Enumeration
+    # progress is called with every height once it is done, and None is yielded after it; cegis allows add_example.
+    # cached=False skips config.enumeration_cache, whose term ids are wrong when another enumeration shares the store.
+    session = current()
+    config = session.config
+    stats = session.stats
+    grammar = syntax.Grammar(rules, nonterminals, initial)
+    rules, nonterminals = grammar
+    terms = session.terms
+    examples_used = len(examples)  # by the OE tables
+    # heights enumerated without observational equivalence don't depend on the examples, and are replayed from
+    # config.enumeration_cache when they were enumerated before
+    store = EnumerationCache(config.enumeration_cache, rules) if config.enumeration_cache and cached else None
+    key = grammar_key(rules, nonterminals, trs) if store else None
+    # a TreeRewritingSystem is applied to the terms as they are built rather than to their sources
+    rewriting = trs if isinstance(trs, TreeRewritingSystem) else None
+    if rewriting is not None:
+        trs = None
+    records = store.load(key) if store else []
     current_height = 1
-    instances = {it: get_ground_exprs(it, rules, nonterminals) for it in nonterminals}
-    instances_joined = {it: {''.join(itt) for itt in instances[it]} for it in nonterminals}
-    global prog_result_cache
-    prog_result_cache = {it: [eval_cached(it, k) for k, _ in examples] for it in instances_joined[initial]}
+    instances = {it: set_used() for it in nonterminals}
+    instances_joined = {it: {} for it in nonterminals}
+    if records:
+        debug(f"DEBUG: {len(records) - 1} heights of this grammar are cached")
+        entries, new_instances, _ = records[0]
+        terms.extend(entries)
+    else:
+        new_instances = {it: [(term, term) for term in
+                              set_used(terms.leaf(''.join(itt)) for itt in get_ground_exprs(it, grammar))]
+                         for it in nonterminals}
+        if store:
+            store.save(key, 0, terms.entries(), new_instances, [])
+    add_instances(instances, instances_joined, new_instances)
     debug(f"DEBUG: Currently trying ground expressions")
     for instance in instances[initial]:
-        yield ''.join(instance)
+        yield terms.string(instance)
+    if progress is not None:
+        progress(0, {it: len(instances[it]) for it in nonterminals})
+        yield None
+    frontier = None  # the instances added by the previous height, None for all of them
+    oe_tables = None  # the OE tables of the instances once observational equivalence starts, kept up to date
     while True:
         if current_height == depth_limit:
             return
-        debug(f"DEBUG: Currently trying expressions of height {current_height}")
+        if cancellation is not None:
+            cancellation.check()
+        if config.debug:
+            debug(f"DEBUG: Currently trying expressions of height {current_height}")
+
+        skipped = config.depth_for_observational_equivalence > current_height or \
+                  config.depth_for_observational_equivalence < 0
+        if skipped and current_height < len(records):
+            if config.debug:
+                debug(f"DEBUG: replaying height {current_height} from the enumeration cache")
+            entries, new_instances, yields = records[current_height]
+            terms.extend(entries)
+            for value in yields:
+                yield program_source(value, trs)
+            frontier = add_instances(instances, instances_joined, new_instances)
+            if progress is not None:
+                progress(current_height, {it: len(instances[it]) for it in nonterminals})
+                yield None
+            current_height += 1
+            continue
+        recording = store is not None and skipped
+        first_term, yields = len(terms), []
 
         if current_height == config.depth_for_observational_equivalence:
-            instances, instances_joined = clean_instances(instances, nonterminals, examples)
+            instances, instances_joined, oe_tables = clean_instances(instances, instances_joined, nonterminals,
+                                                                     examples, cancellation)
+            if frontier is not None:
+                frontier = {it: frontier[it] & instances[it] for it in nonterminals}
+        elif not skipped and oe_tables is None:
+            oe_tables = build_oe_tables(instances_joined, nonterminals, examples)
+        if len(examples) > examples_used and oe_tables is not None:
+            # the programs told apart by the added examples are combined with the others from this height on
+            revived = {k: set_used(v) for k, v in split_equivalents(oe_tables, examples).items()}
+            short_circuited = short_circuit(revived, grammar)
+            new_instances = {}
+            for k in nonterminals:
+                pairs = ((val, instance_key(val, trs)) for val in revived[k] | short_circuited[k])
+                new_instances[k] = [(val, joined) for val, joined in pairs if joined not in instances_joined[k]]
+            added = add_instances(instances, instances_joined, new_instances, oe_tables)
+            if frontier is not None:
+                frontier = {it: frontier[it] | added[it] for it in nonterminals}
+            for value in added[initial]:
+                yield program_source(value, trs)
+        examples_used = len(examples)
 
         new_values = {it: set_used() for it in nonterminals}
-        new_values_joined = {it: set_used() for it in nonterminals}
         for rule in rules:
-            rule_values = get_values(rule, instances, nonterminals)
-            if not rule_values:
-                debug(f"DEBUG: application of rule {rule} gave nothing new")
-            else:
-                debug(f"DEBUG: application of rule {rule} gave {len(rule_values)} values, for example"
-                      f" {''.join(random.choice(list(rule_values)))}")
-
-            skipped = config.depth_for_observational_equivalence > current_height or \
-                      config.depth_for_observational_equivalence < 0
-            if config.depth_for_observational_equivalence > current_height:
-                debug(f"DEBUG: Observational equivalence is not checked for expressions of height {current_height}")
-            elif config.depth_for_observational_equivalence < 0:
-                debug(f"DEBUG: skipping equivalence checking because it is disabled in config.py")
+            if grammar.is_unit(rule):
+                continue  # its left-hand side gets the expressions of its right-hand side by short-circuiting
+            if len(examples) > examples_used and oe_tables is not None:
+                for k, revived in split_equivalents(oe_tables, examples).items():
+                    new_values[k] |= set_used(revived)
+                    if k == initial:
+                        for value in revived:
+                            yield program_source(value, trs)
+            examples_used = len(examples)
+            if config.debug:
+                if config.depth_for_observational_equivalence > current_height:
+                    debug(f"DEBUG: Observational equivalence is not checked for expressions of height {current_height}")
+                elif config.depth_for_observational_equivalence < 0:
+                    debug(f"DEBUG: skipping equivalence checking because it is disabled in config.py")
 
             new_values_for_lhs = []
-            new_values_for_lhs_joined = []
-            for value in rule_values:
-                joined = ''.join(value)
-                found_equiv = (not skipped) and equiv_to_any(instances_joined[rule.lhs] | new_values_joined[rule.lhs],
-                                                             joined, examples)
-                if not found_equiv:
-                    new_values_for_lhs.append(value)
-                    new_values_for_lhs_joined.append(joined)
-                    if rule.lhs == initial:
-                        prog_result_cache[joined] = [eval_cached(joined, k) for k, _ in examples]
-                        if trs:
-                            joined = apply_trs(joined, trs)
-                        yield joined
+            rule_values = eval_failures = 0
+            if stats is not None:
+                rule_started = time.perf_counter()
+                stats.current = stats.rule(rule)
+            values = get_values(rule, instances, grammar, frontier, rewriting, cancellation)
+            try:
+                for value in prefetch(values, constants=not skipped, results=not skipped or rule.lhs == initial):
+                    rule_values += 1
+                    found_equiv = (not skipped) and equiv_to_any(oe_tables[rule.lhs], value, examples)
+                    if not found_equiv:
+                        new_values_for_lhs.append(value)
+                        if rule.lhs == initial:
+                            if recording:
+                                yields.append(value)
+                            yield program_source(value, trs)
+                    if stats is not None and stats.profiling and fails_on_an_example(value):
+                        eval_failures += 1
+            finally:  # also when the synthesis stops in the middle of the rule
+                if stats is not None:
+                    stats.rule_done(rule, current_height, rule_values, len(new_values_for_lhs),
+                                    time.perf_counter() - rule_started, eval_failures)
+
+            if config.debug:
+                if not rule_values:
+                    debug(f"DEBUG: application of rule {rule} gave nothing new")
+                else:
+                    debug(f"DEBUG: application of rule {rule} gave {rule_values} values, {len(new_values_for_lhs)} of"
+                          f" them not equivalent to any seen before")
 
             new_values[rule.lhs] |= set_used(new_values_for_lhs)
-            new_values_joined[rule.lhs] |= set_used(new_values_for_lhs_joined)
+            if not skipped:
+                for value in new_values_for_lhs:
+                    oe_tables[rule.lhs].add(value, instance_key(value, trs))
 
         if len(list(it for it in nonterminals if len(new_values[it]) > 0)) == 0:
             return
 
-        short_circuited = short_circuit(new_values, nonterminals, rules)
-        short_circuited_joined = {it: map(lambda x: ''.join(x), short_circuited[it]) for it in nonterminals}
-        for value in short_circuited_joined[initial]:
-            prog_result_cache[value] = [eval_cached(value, k) for k, _ in examples]
-            if trs:
-                value = apply_trs(value, trs)
-            yield value
+        short_circuited = short_circuit(new_values, grammar)
+        for value in prefetch(iter(short_circuited[initial]), constants=False, results=True):
+            if recording:
+                yields.append(value)
+            yield program_source(value, trs)
 
+        new_instances = {}
         for k in nonterminals:
-            new_instances = []
-            new_instances_joined = []
+            new_instances[k] = []
             for val in short_circuited[k] | new_values[k]:
-                joined = ''.join(val)
-                if trs:
-                    joined = apply_trs(joined, trs)
-                flag = joined in instances_joined[k]
-                if not flag:
-                    new_instances.append(val)
-                    new_instances_joined.append(joined)
-            instances_joined[k] |= set_used(new_instances_joined)
-            instances[k] |= set_used(new_instances)
+                joined = instance_key(val, trs)
+                if joined not in instances_joined[k]:
+                    new_instances[k].append((val, joined))
+                elif trs and stats is not None and val in new_values[k] and terms.rules[val] is not None:
+                    stats.rule(terms.rules[val]).pruned_trs += 1
+        frontier = add_instances(instances, instances_joined, new_instances, oe_tables)
+        if recording:
+            store.save(key, current_height, terms.entries(first_term), new_instances, yields)
+        if progress is not None:
+            progress(current_height, {it: len(instances[it]) for it in nonterminals})
+            yield None
         current_height += 1
+
+
+def expand_top_down(grammar, examples, trs, depth_limit, cancellation=None, progress=None, cegis=False):
+    """
+    Top-down enumeration of the programs of grammar, fewest rules first. Expressions not in normal form or
+    observationally equivalent to a kept one are dropped; progress and cegis are like in expand.
+    """
+    session = current()
+    config = session.config
+    stats = session.stats
+    terms = session.terms
+    rules, nonterminals = grammar
+    initial = grammar.initial
+    rewriting = trs if isinstance(trs, TreeRewritingSystem) else None
+    if rewriting is not None:
+        trs = None
+    # the rules that can replace each nonterminal, and the fewest rules and least height of its expressions
+    choices = {it: [rule for lhs in [it] + grammar.units[it] for rule in grammar.rules_by_lhs[lhs]
+                    if not grammar.is_unit(rule)] for it in nonterminals}
+    min_size = dict.fromkeys(nonterminals, float("inf"))
+    min_height = dict.fromkeys(nonterminals, float("inf"))
+    changed = True
+    while changed:
+        changed = False
+        for it in nonterminals:
+            for rule in choices[it]:
+                arguments = grammar.arguments[rule]
+                size = 1 + sum(min_size[arg] for arg in arguments)
+                height = 1 + max(min_height[arg] for arg in arguments) if arguments else 0
+                if size < min_size[it] or height < min_height[it]:
+                    min_size[it], min_height[it] = min(size, min_size[it]), min(height, min_height[it])
+                    changed = True
+    rule_size = {rule: 1 + sum(min_size[arg] for arg in grammar.arguments[rule]) for rule in rules}
+    rule_height = {rule: 1 + max(min_height[arg] for arg in grammar.arguments[rule]) if grammar.arity(rule) else 0
+                   for rule in rules}
+    normal = {}  # term -> whether its source is in normal form by trs
+    order = itertools.count()  # breaks ties in the heap, oldest first
+    yielded = set()
+
+    def start():
+        # a frame is (rule, nonterminal, children, nonterminals left, level, parent frame) for an expression whose
+        # first nonterminals are the children, to be put in place of the nonterminal at level (the count of rules
+        # above it) of its parent. The root frame holds the program.
+        tables = {it: ObservationalEquivalenceTable(examples, it, ConstantTable()) for it in nonterminals}
+        kept = {it: set() for it in nonterminals}
+        return tables, kept, [(min_size[initial], next(order), (None, None, (), (initial,), -1, None))]
+
+    def keep(term, rule, nonterminal, size):
+        """
+        Whether the expression term, built by rule, can be put in place of nonterminal.
+        """
+        if term in kept[nonterminal]:
+            return True
+        if trs:
+            if term not in normal:
+                source = terms.string(term)
+                normal[term] = apply_trs(source, trs) == source
+            if not normal[term]:
+                if stats is not None:
+                    stats.rule(rule).pruned_trs += 1
+                return False
+        if stats is not None:
+            previous, stats.current = stats.current, stats.rule(rule)
+        ret = True
+        if 0 <= config.depth_for_observational_equivalence <= size:
+            ret = not equiv_to_any(tables[nonterminal], term, examples)
+            if ret:
+                tables[nonterminal].add(term)
+        if stats is not None:
+            stats.rule_done(rule, size, 1, int(ret), 0)
+            stats.current = previous  # of the bottom-up enumeration running alongside, if there is one
+        if ret:
+            kept[nonterminal].add(term)
+        return ret
+
+    def complete(frame, term, rule, cost, size):
+        """
+        Puts the expression term, built by rule, in place of the first nonterminal left of frame, and builds the
+        expressions that completes. Returns the program once it is complete, otherwise None.
+        """
+        while True:
+            frame_rule, nonterminal, children, left, level, parent = frame
+            if not keep(term, rule, left[0], size):
+                return None
+            children += (term,)
+            if len(left) > 1:
+                heapq.heappush(heap, (cost, next(order), (frame_rule, nonterminal, children, left[1:], level, parent)))
+                return None
+            if frame_rule is None:
+                return term
+            if rewriting:
+                term = rewriting.rewrite(terms, frame_rule, children)
+                if terms.rules[term] is not frame_rule or terms.children[term] != children:
+                    if stats is not None:
+                        stats.rule(frame_rule).pruned_trs += 1
+                    return None  # its normal form is built from other children
+            else:
+                term = terms.make(frame_rule, children)
+            frame, rule = parent, frame_rule
+
+    tables, kept, heap = start()
+    examples_used = len(examples)
+    size = 0  # of the programs being generated, the number of their rules minus one
+    popped = 0
+    while heap:
+        popped += 1
+        if cancellation is not None and not popped % CANCELLATION_CHECK_INTERVAL:
+            cancellation.check()
+        if len(examples) > examples_used:
+            debug("DEBUG: examples were added, starting the top-down enumeration over")
+            tables, kept, heap = start()
+            examples_used = len(examples)
+        cost, _, frame = heapq.heappop(heap)
+        if cost - 1 > size:
+            if progress is not None:
+                for done in range(size, cost - 1):
+                    progress(done, {it: len(kept[it]) for it in nonterminals})
+                yield None
+            size = cost - 1
+            if config.debug:
+                debug(f"DEBUG: Currently trying programs of {cost} rules")
+        nonterminal, level = frame[3][0], frame[4] + 1
+        rest = cost - min_size[nonterminal]
+        for rule in choices[nonterminal]:
+            if depth_limit is not None and level + rule_height[rule] >= depth_limit:
+                continue
+            if grammar.arity(rule):
+                heapq.heappush(heap, (rest + rule_size[rule], next(order),
+                                      (rule, nonterminal, (), grammar.arguments[rule], level, frame)))
+                continue
+            program = complete(frame, terms.leaf(''.join(rule.rhs)), rule, rest + 1, size)
+            if program is not None and program not in yielded:
+                yielded.add(program)
+                yield program_source(program, trs)
+    if progress is not None:
+        progress(size, {it: len(kept[it]) for it in nonterminals})
+        yield None
+
+
+def alternate(*generators):
+    """
+    Generates the items of the generators in turn, one of each at a time, until they all run out.
+    """
+    generators = list(generators)
+    while generators:
+        for g in list(generators):
+            try:
+                yield next(g)
+            except StopIteration:
+                generators.remove(g)
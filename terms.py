@@ -0,0 +1,201 @@
+# Hash-consed store for the terms built by the bottom-up enumeration
+
+from collections import OrderedDict
+
+# fingerprints are the UTF-8 bytes of a term's source read as a base 256 number, modulo this prime
+FINGERPRINT_MODULUS = (1 << 128) - 159
+SIZE_SHIFT = 128
+FINGERPRINT_MASK = (1 << SIZE_SHIFT) - 1
+SLOT = None  # stands for a nonterminal in a rule's layout
+
+
+def string_fingerprint(string):
+    """
+    An integer identifying string, made of its size in bytes and its bytes modulo FINGERPRINT_MODULUS.
+    The fingerprint of a concatenation can be computed from those of its parts, see TermStore.make.
+    """
+    data = string.encode()
+    return (len(data) << SIZE_SHIFT) | (int.from_bytes(data, "big") % FINGERPRINT_MODULUS)
+
+
+class TermStore:
+    """
+    Hash-consed terms: every term is an integer id for a rule applied to the terms of its nonterminals, and sources
+    are only built when needed. Ground expressions are leaves, which keep their source.
+    """
+
+    def __init__(self, nonterminals, max_strings=100000):
+        self.nonterminals = nonterminals
+        self.max_strings = max_strings
+        self.rules = []
+        self.children = []
+        self.fingerprints = []
+        self.inputs = []
+        self.ids = {}  # fingerprint -> id of the first term with it
+        self.collisions = {}  # fingerprint -> ids of the later terms with it, whose sources differ from the first's
+        self.layouts = {}  # rule -> terminal strings and SLOTs, with the fingerprint of each terminal string
+        self.strings = OrderedDict()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def layout(self, rule):
+        if rule not in self.layouts:
+            layout = []
+            terminals = []
+            for token in rule.rhs + [SLOT]:
+                if token is SLOT or token in self.nonterminals:
+                    if terminals:
+                        string = ''.join(terminals)
+                        layout.append((string, string_fingerprint(string)))
+                        terminals = []
+                    if token is not SLOT:
+                        layout.append((SLOT, None))
+                else:
+                    terminals.append(token)
+            self.layouts[rule] = layout
+        return self.layouts[rule]
+
+    def add(self, fingerprint, rule, children, mentions_input):
+        term = self.ids.get(fingerprint)
+        if term is None:
+            term = self.ids[fingerprint] = self.new(fingerprint, rule, children, mentions_input)
+        elif not self.same(term, rule, children):
+            colliding = self.collisions.setdefault(fingerprint, [])
+            term = next((it for it in colliding if self.same(it, rule, children)), None)
+            if term is None:
+                term = self.new(fingerprint, rule, children, mentions_input)
+                colliding.append(term)
+        return term
+
+    def new(self, fingerprint, rule, children, mentions_input):
+        self.rules.append(rule)
+        self.children.append(children)
+        self.fingerprints.append(fingerprint)
+        self.inputs.append(mentions_input)
+        return len(self.rules) - 1
+
+    def same(self, term, rule, children):
+        """
+        Whether the source of term is the one of rule applied to children (for a leaf, children is the source).
+        """
+        if self.rules[term] is rule and self.children[term] == children:
+            return True
+        return self.string(term) == self.source(rule, children)
+
+    def find(self, string):
+        """
+        The term whose source is string, or None if there is none.
+        """
+        fingerprint = string_fingerprint(string)
+        term = self.ids.get(fingerprint)
+        if term is None or self.string(term) == string:
+            return term
+        return next((it for it in self.collisions.get(fingerprint, ()) if self.string(it) == string), None)
+
+    def entries(self, start=0):
+        """
+        The terms from id start on as (rule, children, fingerprint, mentions input) tuples, see extend.
+        """
+        return list(zip(self.rules[start:], self.children[start:], self.fingerprints[start:], self.inputs[start:]))
+
+    def extend(self, entries):
+        """
+        Adds terms given by entries (taken from a store with the same terms up to here) with the next ids.
+        """
+        for rule, children, fingerprint, mentions_input in entries:
+            self.add(fingerprint, rule, children, mentions_input)
+
+    def leaf(self, string):
+        """
+        The term of a ground expression.
+        """
+        fingerprint = string_fingerprint(string)
+        term = self.add(fingerprint, None, string, "input" in string)
+        return term
+
+    def make(self, rule, children):
+        """
+        The term of rule applied to the children, which are the terms of its nonterminals from left to right.
+        """
+        value, size, mentions_input = 0, 0, False
+        children_iter = iter(children)
+        for string, fingerprint in self.layout(rule):
+            if string is SLOT:
+                child = next(children_iter)
+                fingerprint = self.fingerprints[child]
+                mentions_input = mentions_input or self.inputs[child]
+            else:
+                mentions_input = mentions_input or "input" in string
+            piece_size = fingerprint >> SIZE_SHIFT
+            value = (value * pow(256, piece_size, FINGERPRINT_MODULUS) + (fingerprint & FINGERPRINT_MASK)) \
+                % FINGERPRINT_MODULUS
+            size += piece_size
+        return self.add((size << SIZE_SHIFT) | value, rule, children, mentions_input)
+
+    def string(self, term):
+        """
+        The source of the term.
+        """
+        rule = self.rules[term]
+        if rule is None:
+            return self.children[term]
+        string = self.strings.get(term)
+        if string is not None:
+            self.strings.move_to_end(term)
+            return string
+        string = self.source(rule, self.children[term])
+        self.strings[term] = string
+        if len(self.strings) > self.max_strings:
+            self.strings.popitem(last=False)
+        return string
+
+    def source(self, rule, children):
+        if rule is None:
+            return children
+        children = iter(children)
+        return ''.join(self.string(next(children)) if piece is SLOT else piece for piece, _ in self.layout(rule))
+
+
+class TreeRewritingSystem:
+    """
+    Term rewriting rules matching on grammar productions rather than on strings, applied as terms are built (see
+    syntax.parse_tree_rewriting_rules).
+    """
+
+    def __init__(self, rules, description):
+        self.description = description  # the rules as they were given
+        # patterns are ("var", name), ("ground", fingerprint, string, node pattern) or ("node", rule, children patterns)
+        self.rules_by_production = {}
+        for lhs, rhs in rules:
+            self.rules_by_production.setdefault(lhs[1], []).append((lhs, rhs))
+
+    def __bool__(self):
+        return bool(self.rules_by_production)
+
+    def rewrite(self, store, rule, children):
+        """
+        The normal form of rule applied to children (which are in normal form), as a term of store.
+        """
+        for lhs, rhs in self.rules_by_production.get(rule, ()):
+            bindings = {}
+            if all(self.match(store, pattern, child, bindings) for pattern, child in zip(lhs[2], children)):
+                return self.build(store, rhs, bindings)
+        return store.make(rule, children)
+
+    def match(self, store, pattern, term, bindings):
+        if pattern[0] == "var":
+            return bindings.setdefault(pattern[1], term) == term
+        if pattern[0] == "ground":
+            return store.fingerprints[term] == pattern[1] and store.string(term) == pattern[2]
+        return store.rules[term] is pattern[1] and \
+            all(self.match(store, it, child, bindings) for it, child in zip(pattern[2], store.children[term]))
+
+    def build(self, store, pattern, bindings):
+        if pattern[0] == "var":
+            return bindings[pattern[1]]
+        if pattern[0] == "ground" and not pattern[3][2]:
+            return store.leaf(pattern[2])  # a ground expression of the grammar, which the enumeration makes a leaf
+        if pattern[0] == "ground":
+            pattern = pattern[3]
+        return self.rewrite(store, pattern[1], tuple(self.build(store, it, bindings) for it in pattern[2]))
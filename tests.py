@@ -1,13 +1,31 @@
+import asyncio
+import itertools
+import json
+import os
 import re
+import signal
+import tempfile
+import threading
+import time
 import unittest
 
+import benchmark
 import config
 import syntax
+import synthesizer
+import terms
+import vectorized
 from synthesizer import *
 from stdlib import *
 
 
 class SynthesizerTests(unittest.TestCase):
+    rules_arithmetic = syntax.parse(r"""
+    PROGRAM ::= EXPR
+    EXPR ::= input | EXPR * EXPR | CONST | EXPR + EXPR | (- EXPR)
+    CONST ::= 0 | 1 | 2 | 3 | 4
+    """)
+
     def test_arithm(self):
         rules_arithm = syntax.parse(r"""
         PROGRAM ::= NUM
@@ -82,6 +100,15 @@ class SynthesizerTests(unittest.TestCase):
         for k, v in examples:
             self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
 
+    def test_frontier_order(self):
+        # the products with a child from the frontier come in the order of the full product, older instances first
+        options = [set_used(range(6)), set_used(range(4)), set_used(range(5))]
+        for sizes in itertools.product(range(4), repeat=3):
+            frontier = [set(option[len(option) - size:]) for option, size in zip(options, sizes)]
+            expected = [children for children in itertools.product(*options)
+                        if any(child in new for child, new in zip(children, frontier))]
+            self.assertEqual(list(frontier_product(options, frontier)), expected)
+
     def test_listops_lambda_basic(self):
         rules_listops_lambda_basic = syntax.parse(r"""
         PROGRAM ::= EXPR
@@ -537,5 +564,597 @@ class SynthesizerTests(unittest.TestCase):
         for k, v in examples:
             self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
 
+    def test_composed_results(self):
+        test_composed_results = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= sorted(EXPR) | list(reversed(EXPR)) | cons(ITEM,\s EXPR) | input
+        ITEM ::= input[N] | N
+        N ::= 0 | 1 | -1
+        """)
+
+        examples = [([3, 1, 2], [1, 1, 2, 3]), ([5, 4], [4, 4, 5])]
+        res = do_synthesis(test_composed_results, examples)
+        # synthesize cons(input[1], sorted(input)), with results composed from those of its subexpressions
+        self.assertIsNotNone(res)
+        print(res)
+        for k, v in examples:
+            self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+        for term, outputs in synthesizer.prog_result_cache.items():
+            prog = synthesizer.terms.string(term)
+            for (k, _), out in zip(examples, outputs):
+                expected = eval(f"(lambda input: {prog})({k})")
+                self.assertEqual(out, expected)
+
+    def test_parallel_evaluation(self):
+        examples = [(0, 1), (1, 2), (-2, 5), (3, 10)]
+        depth = config.depth_for_observational_equivalence
+        workers = config.workers
+        try:
+            config.set_depth_for_observational_equivalence(2)
+            expected = do_synthesis(self.rules_arithmetic, examples)
+            config.set_workers(2)
+            res = do_synthesis(self.rules_arithmetic, examples)  # the same program as without workers
+        finally:
+            config.set_depth_for_observational_equivalence(depth)
+            config.set_workers(workers)
+        self.assertIsNotNone(res)
+        print(res)
+        self.assertEqual(res, expected)
+        for k, v in examples:
+            self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+
+    def test_batch_synthesis(self):
+        specs = [[(0, 1), (1, 2), (-2, 5), (3, 10)],  # synthesize x^2 + 1
+                 [(0, 0), (1, 2), (-2, -4)],  # synthesize 2x
+                 [(0, 3), (1, 4)],  # synthesize x + 3
+                 [(0, 7)]]  # synthesize 7
+        res = do_batch_synthesis(self.rules_arithmetic, specs)
+        print(res)
+        self.assertEqual(len(res), len(specs))
+        for prog, examples in zip(res, specs):
+            self.assertIsNotNone(prog)
+            for k, v in examples:
+                self.assertEqual(eval(f"(lambda input: {prog})({k})"), v)
+
+    def test_enumeration_cache(self):
+        examples = [(0, 1), (1, 2), (-2, 5), (3, 10)]
+        expected = do_synthesis(self.rules_arithmetic, examples)
+
+        def solutions(strategy):  # of x + 3, all of them up to height 2
+            return [event.program for event in synthesis_events(self.rules_arithmetic, [(0, 3), (1, 4)], depth_limit=3,
+                                                                strategy=strategy) if isinstance(event, Solution)]
+
+        depth = config.depth_for_observational_equivalence
+        config.set_depth_for_observational_equivalence(-1)  # so every height is cached
+        try:
+            expected_both = solutions("both")
+        finally:
+            config.set_depth_for_observational_equivalence(depth)
+        with tempfile.TemporaryDirectory() as directory:
+            config.set_enumeration_cache(os.path.join(directory, "enumeration.db"))
+            try:
+                first = do_synthesis(self.rules_arithmetic, examples)  # enumerates and fills the cache
+                second = do_synthesis(self.rules_arithmetic, examples)  # replays the cached heights
+                config.set_depth_for_observational_equivalence(-1)
+                solutions("bottom-up")
+                # the top-down enumeration adds terms to the store, so the cache can't be replayed alongside it
+                both = solutions("both")
+            finally:
+                config.set_enumeration_cache(None)
+                config.set_depth_for_observational_equivalence(depth)
+        print(second)
+        self.assertEqual(first, expected)
+        self.assertEqual(second, expected)
+        self.assertEqual(both, expected_both)
+
+    def test_proving(self):
+        rules_proving = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= input | EXPR + EXPR | (- EXPR) | (EXPR - 1)
+        """)
+
+        examples = [(0, -1), (1, 1), (-2, -5)]
+        prove = config.prove
+        depth = config.depth_for_observational_equivalence
+        try:
+            config.set_prove(True)
+            config.set_depth_for_observational_equivalence(1)
+            res = do_synthesis(rules_proving, examples)
+            # synthesize 2x - 1, pruning programs proven equivalent to others
+        finally:
+            config.set_prove(prove)
+            config.set_depth_for_observational_equivalence(depth)
+        self.assertIsNotNone(res)
+        print(res)
+        for k, v in examples:
+            self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+        self.assertTrue(synthesizer.provers)
+
+        rules_variables = syntax.parse(r"""
+        PROGRAM ::= [EXPR \sfor \sx \sin \sinput]
+        EXPR ::= x | 1 | 2 | (EXPR + EXPR) | (EXPR * EXPR) | (EXPR % EXPR) | (EXPR / EXPR)
+        """)
+
+        for examples in [([1, 2], [3, 5])], [([1, 2, 3], [0.5, 1.0, 1.5])]:  # synthesize 2x + 1, then x / 2
+            session = Synthesizer(stats=True, prove=True, depth_for_observational_equivalence=1)
+            res = session.do_synthesis(rules_variables, examples)
+            self.assertIsNotNone(res)
+            print(res)
+            for k, v in examples:
+                self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+            # x is not bound in EXPR, so its expressions are proven equivalent, e.g. (1 + x) to (x + 1)
+            self.assertGreater(session.stats.outcomes["SEEN_NOT_A_CONSTANT"], 0)
+        # Z3 divides Ints differently from Python, so divisions are never proven equivalent
+        self.assertFalse(exactly_encodable("(x / 2)", {"x"}))
+        self.assertTrue(exactly_encodable("((x * 2) - 1)", {"x"}))
+        session = Synthesizer(stats=True, depth_for_observational_equivalence=1)
+        self.assertIsNotNone(session.do_synthesis(rules_variables, examples))
+        self.assertEqual(session.stats.outcomes["SEEN_NOT_A_CONSTANT"], 0)  # nothing is proven without prove
+
+    def test_tree_rewriting(self):
+        test_tree_rewriting = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= LIST[N] | (EXPR OP EXPR)
+        N ::= 0 | 1 | 2 | -1 | -2
+        OP ::= \s-\s | \s+\s 
+        LIST ::= input | sorted(LIST) | reversed(LIST)
+        """)
+        test_tree_rewriting_trs = syntax.parse_tree_rewriting_rules(r"""
+        sorted(reversed(LIST)) -> sorted(LIST)
+        sorted(sorted(LIST)) -> sorted(LIST)
+        reversed(reversed(LIST)) -> LIST
+        """, test_tree_rewriting)
+
+        examples = [([16, 77, 31], 46), ([60, 9, 61, 63, 1], 2), ([5, 4, 3, 2, 1], 1)]
+        res = do_synthesis(test_tree_rewriting, examples, trs=test_tree_rewriting_trs)
+        # synthesize sorted(input)[-1] - sorted(input)[-2]
+        self.assertIsNotNone(res)
+        print(res)
+        for k, v in examples:
+            self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+        for term in range(len(synthesizer.terms)):  # terms not in normal form are never built
+            self.assertNotRegex(synthesizer.terms.string(term), r"sorted\((sorted|reversed)\(|reversed\(reversed\(")
+
+        # a right-hand side without variables is built with its rules, like the same expression when it is enumerated
+        ground_trs = syntax.parse_tree_rewriting_rules(r"""
+        sorted(reversed(input)) -> sorted(input)
+        """, test_tree_rewriting)
+        rules = {str(rule): rule for rule in test_tree_rewriting[0]}
+        sorted_rule, reversed_rule = rules["LIST -> sorted ( LIST )"], rules["LIST -> reversed ( LIST )"]
+        store = terms.TermStore(test_tree_rewriting[1])
+        leaf = store.leaf("input")
+        term = ground_trs.rewrite(store, sorted_rule, (store.make(reversed_rule, (leaf,)),))
+        self.assertEqual((store.rules[term], store.children[term]), (sorted_rule, (leaf,)))
+        self.assertEqual(store.make(sorted_rule, (leaf,)), term)
+
+    def test_fingerprint_collisions(self):
+        rules, nonterminals = syntax.parse(r"""
+        PROGRAM ::= sorted(EXPR)
+        EXPR ::= input
+        """)
+
+        store = terms.TermStore(nonterminals)
+        sources = ["input[3 * len(input)-w0", "input[1 * len(input)-xn"]  # different sources, same fingerprint
+        leaves = [store.leaf(source) for source in sources]
+        programs = [store.make(rules[0], (leaf,)) for leaf in leaves]
+        self.assertEqual(store.fingerprints[programs[0]], store.fingerprints[programs[1]])
+        self.assertNotEqual(programs[0], programs[1])
+        for source, leaf, program in zip(sources, leaves, programs):
+            self.assertEqual(store.string(leaf), source)
+            self.assertEqual(store.find(f"sorted({source})"), program)
+            self.assertEqual(store.make(rules[0], (store.leaf(source),)), program)
+        self.assertIsNone(store.find("sorted(input)"))
+
+    def test_top_down(self):
+        test_top_down = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= (LAMBDA_REC_EXPR)(input) | CONST
+        CONST ::= 0 | 1
+        VAR ::= 0 | 1 | x
+        LAMBDA_REC_EXPR ::= z(lambda\s rec:\s lambda\s x:\s REC_EXPR)
+        REC_EXPR ::= VAR | VAR OP REC_EXPR
+        REC_EXPR ::= (VAR \sif\s x \s==\s 0 \selse\s rec(x\s -\s 1) OP VAR)
+        OP ::= \s+\s | \s*\s
+        """)
+
+        examples = [(0, 1), (5, 120)]
+        for strategy in "top-down", "both":
+            res = do_synthesis(test_top_down, examples, strategy=strategy)  # synthesize input!
+            self.assertIsNotNone(res)
+            print(res)
+            for k, v in examples:
+                self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+        self.assertRaises(ValueError, do_synthesis, test_top_down, examples, strategy="sideways")
+
+        test_top_down_lists = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= LIST[N] | (EXPR OP EXPR)
+        N ::= 0 | -1
+        OP ::= \s-\s | \s+\s
+        LIST ::= input | sorted(LIST) | reversed(LIST)
+        """)
+        test_top_down_trs = syntax.parse_tree_rewriting_rules(r"""
+        sorted(reversed(LIST)) -> sorted(LIST)
+        sorted(sorted(LIST)) -> sorted(LIST)
+        reversed(reversed(LIST)) -> LIST
+        """, test_top_down_lists)
+
+        # without observational equivalence, both strategies generate the same programs up to a depth
+        session = Synthesizer(depth_for_observational_equivalence=-1)
+        programs = {}
+        for strategy in "bottom-up", "top-down":
+            events = session.synthesis_events(test_top_down_lists, [], depth_limit=4, trs=test_top_down_trs,
+                                              strategy=strategy)
+            programs[strategy] = [event.program for event in events if isinstance(event, synthesizer.Solution)]
+        self.assertEqual(len(programs["top-down"]), len(set(programs["top-down"])))
+        self.assertEqual(set(programs["top-down"]), set(programs["bottom-up"]))
+        self.assertNotIn("sorted(sorted(input))[0]", programs["top-down"])
+
+    def test_grammar_preprocessing(self):
+        test_grammar_preprocessing = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= TERM | EXPR \s+\s TERM | LOOP
+        TERM ::= FACTOR | TERM \s*\s FACTOR
+        FACTOR ::= input | 1 | 2
+        LOOP ::= (LOOP)
+        UNUSED ::= input
+        """)
+        _, nonterminals = test_grammar_preprocessing
+        # LOOP is unproductive and UNUSED unreachable
+        self.assertEqual(nonterminals, {"PROGRAM", "EXPR", "TERM", "FACTOR"})
+        self.assertEqual(test_grammar_preprocessing.units["PROGRAM"], ["EXPR", "TERM", "FACTOR"])
+
+        examples = [(1, 3), (2, 6), (3, 11)]
+        # synthesize input * input + 2, which is only of height 2 when TERM expressions are short-circuited to EXPR
+        res = do_synthesis(test_grammar_preprocessing, examples, depth_limit=3)
+        self.assertIsNotNone(res)
+        print(res)
+        for k, v in examples:
+            self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+
+    def test_vectorized_evaluation(self):
+        test_vectorized_evaluation = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= NUM | (EXPR OP NUM)
+        NUM ::= input | 1 | 2 | 3
+        OP ::= \s+\s | \s-\s | \s*\s | \s//\s | \s<\s
+        """)
+
+        examples = [(x, x * x // 3) for x in range(-50, 50)]
+        res = do_synthesis(test_vectorized_evaluation, examples)  # synthesize ((input * input) // 3)
+        self.assertIsNotNone(res)
+        print(res)
+        for k, v in examples:
+            self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+        if vectorized.numpy is not None:
+            self.assertGreater(synthesizer.vectorizer.vectorized, 0)
+
+    def test_example_scheduling(self):
+        test_example_scheduling = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= sorted(EXPR) | list(reversed(EXPR)) | EXPR[N:] | EXPR[:N] | input
+        N ::= 1 | 2 | -1
+        """)
+
+        large = [(i * 7919) % 10007 for i in range(20000)]
+        examples = [(large, sorted(large, reverse=True)[1:-1]), ([3, 1, 4, 1, 5], [4, 3, 1])]
+        res = do_synthesis(test_example_scheduling, examples)  # synthesize list(reversed(sorted(input)[1:-1]))
+        self.assertIsNotNone(res)
+        print(res)
+        for k, v in examples:
+            self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+        # the small example rejects candidates much faster, so it ends up being checked first
+        self.assertEqual(synthesizer.scheduler.order(), (1, 0))
+        self.assertGreater(synthesizer.scheduler.rejections[1], synthesizer.scheduler.rejections[0])
+
+    def test_cegis(self):
+        test_cegis = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= input | (EXPR * EXPR) | (EXPR - EXPR)
+        """)
+
+        # on the first two examples, (input * input) and (input - input) are equivalent to input
+        examples = [(x, x * x * x - x) for x in [0, 1] + list(range(-20, 20))]
+        depth = config.depth_for_observational_equivalence
+        try:
+            config.set_depth_for_observational_equivalence(1)
+            config.set_cegis_examples(2)
+            res = do_synthesis(test_cegis, examples)  # synthesize (((input * input) * input) - input)
+        finally:
+            config.set_depth_for_observational_equivalence(depth)
+            config.set_cegis_examples(None)
+        self.assertIsNotNone(res)
+        print(res)
+        for k, v in examples:
+            self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+        self.assertLess(len(synthesizer.examples), len(examples))
+
+    def test_constants_by_nonterminal(self):
+        rules_constants = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= input | (EXPR * EXPR) | (EXPR - EXPR) | (EXPR // EXPR) | CONST
+        CONST ::= 1 | 2 | -1
+        """)
+
+        inputs = [0, 1, -2, 3, 7]
+        rules, nonterminals = rules_constants
+
+        def programs(order, depth):
+            session = Synthesizer(depth_for_observational_equivalence=depth)
+            with session.running(), enumeration((rules, order), [(k, None) for k in inputs], -1, None, 3,
+                                                None) as progs:
+                return list(progs)
+
+        def results(prog):  # failing on an input is a result of its own
+            return tuple(None if isinstance(value, NoResult) else value
+                         for value in (eval_cached(prog, k) for k in inputs))
+
+        everything = {results(prog) for prog in programs(list(nonterminals), -1)}
+        # the constants of CONST must not prune those of EXPR, whichever nonterminal is enumerated first
+        for order in sorted(nonterminals), sorted(nonterminals, reverse=True):
+            progs = programs(order, 1)
+            self.assertEqual(len(progs), 1449)  # as enumerated before the examples were checked lazily
+            self.assertIn("(2*input)", progs)
+            self.assertIn("(1-input)", progs)
+            self.assertEqual({results(prog) for prog in progs}, everything)
+
+    def test_constant_table(self):
+        test_constant_table = syntax.parse(r"""
+        PROGRAM ::= VALUE
+        VALUE ::= EXPR | LIST
+        EXPR ::= NUM | (EXPR + EXPR) | (EXPR * EXPR)
+        NUM ::= 1 | 2 | 3 | 5 | 7
+        LIST ::= [NUM] | (LIST + LIST)
+        """)
+
+        # constants of NUM don't hide the same constants of EXPR
+        examples = [(0, 37), (1, 37)]
+        session = Synthesizer(depth_for_observational_equivalence=1)
+        res = session.do_synthesis(test_constant_table, examples)  # synthesize ((7*5)+2)
+        self.assertIsNotNone(res)
+        print(res)
+        self.assertEqual(eval(res), 37)
+        constants = session.seen_constants
+        self.assertIsNotNone(constants["EXPR"].find(35))
+        self.assertIsNone(constants["EXPR"].find(1000))
+
+        examples = [(0, [5, 3]), (1, [5, 3])]
+        res = session.do_synthesis(test_constant_table, examples)  # synthesize ([5]+[3])
+        self.assertIsNotNone(res)
+        print(res)
+        self.assertEqual(eval(res), [5, 3])
+        self.assertIsNotNone(session.seen_constants["LIST"].find([3]))  # lists are indexed by their elements
+
+    @unittest.skipUnless(hasattr(signal, "setitimer"), "candidates can only be killed where setitimer is available")
+    def test_evaluation_time_limit(self):
+        test_evaluation_time_limit = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= NUM | (EXPR + NUM)
+        NUM ::= input | 1 | sum(1\sfor\s_\sin\sitertools.count())
+        """)
+
+        examples = [(1, 3), (5, 7)]
+        eval_time_limit = config.eval_time_limit
+        config.set_eval_time_limit(0.02)
+        signal.alarm(100)
+        try:
+            res = do_synthesis(test_evaluation_time_limit, examples)  # synthesize ((input + 1) + 1)
+        finally:
+            remaining = signal.alarm(0)
+            config.set_eval_time_limit(eval_time_limit)
+        self.assertIsNotNone(res)
+        print(res)
+        for k, v in examples:
+            self.assertEqual(eval(f"(lambda input: {res})({k})"), v)
+        self.assertGreater(synthesizer.killed["time"], 0)
+        self.assertGreater(remaining, 90)  # the synthesis restored the alarm its timer took the place of
+
+    def test_cancellation(self):
+        test_cancellation = syntax.parse(r"""
+        PROGRAM ::= EXPR < NEG
+        NEG ::= -1000
+        EXPR ::= 1 | input | (EXPR OP EXPR)
+        OP ::= \s+\s | \s*\s | \s-\s
+        """)
+
+        # there is no such program, and most of the enumeration builds expressions of EXPR without yielding programs
+        examples = [(1, True), (2, False), (3, True)]
+        start = time.time()
+        self.assertIsNone(do_synthesis(test_cancellation, examples, timeout=0.2))
+        self.assertLess(time.time() - start, 2)
+
+        token = CancellationToken()
+        threading.Timer(0.2, token.cancel).start()
+        start = time.time()
+        self.assertIsNone(do_synthesis(test_cancellation, examples, timeout=-1, cancellation=token))
+        self.assertLess(time.time() - start, 2)
+
+    def test_concurrent_sessions(self):
+        specs = [[(0, 1), (1, 2), (-2, 5), (3, 10)],  # synthesize x^2 + 1
+                 [(0, 3), (1, 4)]]  # synthesize x + 3
+        sessions = [Synthesizer(compose_results=False), Synthesizer(depth_for_observational_equivalence=-1)]
+        res = [None] * len(specs)
+
+        def synthesize(i):
+            res[i] = sessions[i].do_synthesis(self.rules_arithmetic, specs[i])
+
+        threads = [threading.Thread(target=synthesize, args=(i,)) for i in range(len(specs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(res)
+        for prog, examples in zip(res, specs):
+            self.assertIsNotNone(prog)
+            for k, v in examples:
+                self.assertEqual(eval(f"(lambda input: {prog})({k})"), v)
+        self.assertEqual(sessions[1].config.depth_for_observational_equivalence, -1)
+        self.assertNotEqual(config.depth_for_observational_equivalence, -1)  # the session's config is its own
+
+        hits = sessions[0].cache.hits
+        self.assertEqual(sessions[0].do_synthesis(self.rules_arithmetic, specs[0]), res[0])
+        self.assertGreater(sessions[0].cache.hits, hits)  # programs compiled by the first call are reused
+
+    def test_concurrent_proving(self):
+        rules_concurrent_proving = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= input | EXPR + EXPR | (- EXPR) | (EXPR - 1)
+        """)
+
+        specs = [[(0, -1), (1, 1), (-2, -5)], [(0, 1), (1, 3), (-2, -3)]]  # synthesize 2x - 1 and 2x + 1
+        sessions = [Synthesizer(prove=True, depth_for_observational_equivalence=1) for _ in specs]
+        res = [None] * len(specs)
+
+        def synthesize(i):
+            res[i] = sessions[i].do_synthesis(rules_concurrent_proving, specs[i])
+
+        threads = [threading.Thread(target=synthesize, args=(i,)) for i in range(len(specs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(res)
+        for prog, examples in zip(res, specs):
+            self.assertIsNotNone(prog)
+            for k, v in examples:
+                self.assertEqual(eval(f"(lambda input: {prog})({k})"), v)
+        self.assertIsNot(sessions[0].z3_context, sessions[1].z3_context)  # Z3 contexts can't be used concurrently
+
+        sessions[0].do_synthesis(syntax.parse("PROGRAM ::= input"), [(0, 0)])
+        self.assertEqual(len(sessions[0].semantic_functions), 1)  # only those of the last grammar are kept
+
+    def test_nested_synthesis(self):
+        rules_nested = syntax.parse(r"""
+        PROGRAM ::= SYNTHESIS
+        SYNTHESIS ::= input[2].do_synthesis(input[0],\s input[1]) | input
+        """)
+        rules_inner = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= input | EXPR + EXPR | CONST
+        CONST ::= 1 | 2
+        """)
+
+        inner_examples = [(0, 2), (1, 3)]  # synthesize x + 2
+        expected = do_synthesis(rules_inner, inner_examples)
+        session = Synthesizer()
+        # the candidate synthesizes with the module's session, then with the session running it, which must neither
+        # reset the outer synthesis nor wait for it to finish
+        for synthesizing in synthesizer, session:
+            outer = session.do_synthesis if synthesizing is session else do_synthesis
+            res = outer(rules_nested, [((rules_inner, inner_examples, synthesizing), expected)], timeout=10)
+            print(res)
+            self.assertEqual(res, "input[2].do_synthesis(input[0], input[1])")
+        self.assertEqual(session.do_synthesis(rules_inner, inner_examples), expected)
+
+    def test_streaming_synthesis(self):
+        examples = [(0, 3), (1, 4)]  # synthesize x + 3
+
+        async def collect():
+            return [event async for event in stream_synthesis(self.rules_arithmetic, examples, max_solutions=3)]
+
+        events = asyncio.run(collect())
+        print(events)
+        solutions = [event.program for event in events if isinstance(event, Solution)]
+        self.assertEqual(len(solutions), 3)
+        self.assertEqual(len(set(solutions)), 3)
+        for prog in solutions:
+            for k, v in examples:
+                self.assertEqual(eval(f"(lambda input: {prog})({k})"), v)
+        heights = [event for event in events if isinstance(event, HeightDone)]
+        self.assertEqual([event.height for event in heights], list(range(len(heights))))
+        self.assertGreater(heights[-1].counts["EXPR"], heights[0].counts["EXPR"])
+        self.assertEqual(solutions[0], do_synthesis(self.rules_arithmetic, examples))
+
+        # a height is reported as soon as it is done, before any program of the next one is tried
+        session = Synthesizer(stats=True)
+        heights = []
+        for event in session.synthesis_events(self.rules_arithmetic, [(0, 7), (1, -7)], timeout=10):
+            if isinstance(event, HeightDone):
+                heights.append(event.height)
+                tried = session.stats.heights[event.height + 1:]
+                self.assertEqual(sum(height.candidates for height in tried), 0)
+                if event.height == 2:
+                    break
+        self.assertEqual(heights, [0, 1, 2])
+
+    def test_benchmark(self):
+        rules_benchmark = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= input | EXPR * EXPR | CONST | EXPR + EXPR
+        CONST ::= 0 | 1 | 2
+        """)
+
+        examples = [(0, 2), (1, 3)]
+        session = Synthesizer()
+        res = session.do_synthesis(rules_benchmark, examples)  # synthesize input + 2 at height 1
+        self.assertIsNotNone(res)
+        print(res, session.candidates)
+        self.assertEqual(len(session.candidates), 2)
+        self.assertGreater(session.evaluations, 0)
+        session.do_synthesis(rules_benchmark, examples)
+        self.assertEqual(len(session.candidates), 2)  # the counts add up over the syntheses of the session
+
+        baseline = {"case": {"passed": True, "seconds": 1.0, "candidates": 100, "evaluations": 100, "peak_rss": None}}
+        results = {"case": dict(baseline["case"], seconds=1.01, candidates=200)}
+        self.assertEqual(benchmark.compare(results, baseline, 0.25), [("case", "candidates 100 -> 200")])
+        self.assertEqual(benchmark.compare({"case": None}, baseline, 0.25), [("case", "timed out")])
+        with tempfile.TemporaryDirectory() as directory:  # nothing to compare against, so nothing is run
+            self.assertEqual(benchmark.main(["--baseline", os.path.join(directory, "baseline.json")]), 2)
+
+    def test_stats(self):
+        rules_stats = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= input | (EXPR * EXPR) | (EXPR + EXPR)
+        """)
+
+        examples = [(0, 0), (1, 2), (2, 6), (3, 12)]
+        session = Synthesizer(stats=True, depth_for_observational_equivalence=1)
+        heights = []
+        for event in session.synthesis_events(rules_stats, examples):
+            if isinstance(event, synthesizer.HeightDone):
+                heights.append(session.stats.snapshot())  # read while the synthesis is running
+            else:
+                print(event.program)  # synthesize ((input * input) + input) or the like at height 2
+                break
+        self.assertEqual(len(heights), 2)
+        self.assertEqual(heights[1]["heights"][1]["candidates"], session.candidates[1])
+        self.assertNotIn("OBSERVATIONALLY_EQUIVALENT", heights[1]["outcomes"])  # no two of height 1 are equivalent
+
+        snapshot = json.loads(json.dumps(session.stats.snapshot()))
+        self.assertGreater(snapshot["outcomes"]["OBSERVATIONALLY_EQUIVALENT"], 0)
+        self.assertEqual(sum(it["candidates"] for it in snapshot["heights"]), sum(session.candidates))
+        plus = snapshot["rules"]["EXPR -> ( EXPR + EXPR )"]
+        self.assertGreater(plus["built"], plus["kept"])
+        # the instances of lower heights are checked as well when observational equivalence starts
+        self.assertGreaterEqual(sum(snapshot["outcomes"].values()), sum(it["built"] for it in snapshot["heights"]))
+
+        session.config.stats = False
+        session.do_synthesis(rules_stats, examples)
+        self.assertIsNone(session.stats)
+
+    def test_profile(self):
+        rules_profile = syntax.parse(r"""
+        PROGRAM ::= EXPR
+        EXPR ::= input | (EXPR // EXPR) | (EXPR + EXPR)
+        """)
+
+        examples = [(1, 5), (2, 10), (3, 15)]
+        session = Synthesizer(profile=True, depth_for_observational_equivalence=1)
+        res = session.do_synthesis(rules_profile, examples)  # synthesize (((input+input)+(input+input))+input)
+        self.assertIsNotNone(res)
+        print(res)
+        print(session.stats.report())
+        profile = json.loads(session.stats.report("json"))
+        rules = {it["rule"]: it for it in profile["rules"]}
+        floordiv = rules["EXPR -> ( EXPR / / EXPR )"]
+        self.assertGreater(floordiv["eval_failures"], 0)  # e.g. (input // (input // (input + input)))
+        self.assertGreater(floordiv["pruned_oe"], 0)
+        self.assertEqual(rules["EXPR -> ( EXPR + EXPR )"]["eval_failures"], 0)
+        for rule in rules.values():
+            self.assertEqual(rule["built"], rule["kept"] + rule["pruned_oe"] + rule["pruned_constant"])
+        [expr] = profile["nonterminals"]
+        self.assertEqual(expr["built"], sum(it["built"] for it in profile["rules"]))
+        self.assertRaises(ValueError, session.stats.report, "xml")
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,196 @@
+# Evaluation of arithmetic and boolean programs on all the example inputs at once, using NumPy
+
+import ast
+import operator
+import re
+
+try:
+    import numpy
+except ImportError:  # programs are then evaluated one input at a time
+    numpy = None
+
+# the terminals of a grammar may only be made of these once the name input is taken out of them
+SUPPORTED_TERMINALS_REGEX = re.compile(r"^[\d\s.+\-*/%()<>=!&|^~]*$")
+# with fewer examples, checking and compiling programs for arrays takes longer than evaluating them one input at a time
+MIN_EXAMPLES = 100
+# integers are kept within this magnitude, so int64 arithmetic and conversions to float64 are exact
+INTEGER_LIMIT = 2 ** 53
+# operators failing on some right operands (zero divisors and negative shift counts), by their names in operator
+GUARDED_OPERATORS = {ast.Div: "truediv", ast.FloorDiv: "floordiv", ast.Mod: "mod", ast.LShift: "lshift",
+                     ast.RShift: "rshift"}
+BITWISE_OPERATORS = {ast.BitAnd, ast.BitOr, ast.BitXor}
+FLOAT_OPERATORS = {ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod}
+UNSUPPORTED_COMPARISONS = {ast.In, ast.NotIn, ast.Is, ast.IsNot}  # chained comparisons aren't supported either
+HERE = {"lineno": 1, "col_offset": 0}  # the location of the nodes built here, cheaper than ast.fix_missing_locations
+
+
+class Unsupported(Exception):
+    pass
+
+
+class PlainResults(list):
+    """
+    A results vector of ints, floats and bools, so the tuple of it is already its canonical form.
+    """
+
+
+def get_vectorized_evaluator(rules, nonterminals, inputs):
+    """
+    A VectorizedEvaluator for the programs of the grammar on the inputs, or None if NumPy is not installed, there are
+    less than MIN_EXAMPLES inputs, the grammar has terminals other than numbers, input and operators, or the inputs are
+    not all ints or all floats.
+    """
+    if numpy is None or len(inputs) < MIN_EXAMPLES:
+        return None
+    for rule in rules:
+        for token in rule.rhs:
+            if token not in nonterminals and not SUPPORTED_TERMINALS_REGEX.match(re.sub(r"\binput\b", "", token)):
+                return None
+    if all(type(it) is int and abs(it) <= INTEGER_LIMIT for it in inputs):
+        return VectorizedEvaluator(numpy.array(inputs, dtype=numpy.int64), "int", max(abs(it) for it in inputs))
+    if all(type(it) is float for it in inputs):
+        return VectorizedEvaluator(numpy.array(inputs, dtype=numpy.float64), "float", None)
+    return None
+
+
+class VectorizedEvaluator:
+    """
+    Evaluates programs made of numbers, input, arithmetic and bitwise operators and single comparisons on all the
+    inputs at once: input is an array of them, and a chunk of programs is compiled into a single expression giving the
+    results of all of them.
+    Programs are checked by their syntax trees to compute exactly what Python computes. Every intermediate integer is
+    bounded from the largest input and must stay within INTEGER_LIMIT, booleans are turned into integers before taking
+    part in arithmetic, and an input that makes a program divide by zero or shift by a negative count only fails that
+    program on that input. Programs that fail the check are left to be evaluated one input at a time.
+    """
+
+    def __init__(self, inputs, kind, bound):
+        self.inputs = inputs
+        self.kind = kind  # of the inputs, "int" or "float"
+        self.bound = bound  # of the magnitude of the inputs when they are ints
+        self.vectorized = 0  # programs evaluated here, for debugging
+        self.rejected = 0
+
+    def evaluate(self, sources, failure):
+        """
+        The results vectors of sources on the inputs, as lists with failure() for the inputs a program fails on (or
+        PlainResults if there are none), and None for the programs that must be evaluated one input at a time.
+        """
+        ret = [None] * len(sources)
+        bodies, indices = [], []
+        for i, source in enumerate(sources):
+            try:
+                body, _, _ = self.check(ast.parse(source.strip(), mode="eval").body, len(bodies))
+            except (SyntaxError, ValueError, Unsupported, RecursionError):
+                continue
+            bodies.append(body)
+            indices.append(i)
+        self.rejected += len(sources) - len(bodies)
+        if not bodies:
+            return ret
+        failed = numpy.zeros((len(bodies), len(self.inputs)), dtype=bool)
+
+        def guarded(index, name, left, right):
+            mask = right < 0 if name.endswith("shift") else right == 0
+            if numpy.any(mask):
+                failed[index] |= mask
+                right = numpy.where(mask, 1, right)
+            return getattr(operator, name)(left, right)
+
+        code = compile(ast.Expression(ast.Tuple(bodies, ast.Load(), **HERE)), "<vectorized>", "eval")
+        try:
+            with numpy.errstate(all="ignore"):
+                values = eval(code, {"__builtins__": {}, "input": self.inputs, "_slacc_guarded": guarded})
+        except Exception:
+            return ret
+        self.vectorized += len(bodies)
+        for index, (i, value) in enumerate(zip(indices, values)):
+            row = numpy.broadcast_to(value, self.inputs.shape).tolist()
+            if failed[index].any():
+                ret[i] = [failure() if fail else it for it, fail in zip(row, failed[index])]
+            else:
+                ret[i] = PlainResults(row)
+        return ret
+
+    def check(self, node, index):
+        """
+        Checks the syntax tree of the index-th program of a chunk, and returns a tree evaluating it on arrays along with
+        the kind of its values ("bool", "int" or "float") and a bound of their magnitude when they are ints.
+        The tree is changed in place.
+        """
+        node_type = type(node)
+        if node_type is ast.BinOp:
+            return self.check_operation(node, index)
+        if node_type is ast.Name and node.id == "input":
+            return node, self.kind, self.bound
+        if node_type is ast.Constant:
+            value_type = type(node.value)
+            if value_type is int and abs(node.value) <= INTEGER_LIMIT:
+                return node, "int", abs(node.value)
+            if value_type is bool:
+                return node, "bool", 1
+            if value_type is float:
+                return node, "float", None
+            raise Unsupported()
+        if node_type is ast.UnaryOp and type(node.op) is not ast.Not:
+            node.operand, kind, bound = self.as_number(*self.check(node.operand, index))
+            if type(node.op) is ast.Invert:
+                if kind == "float":
+                    raise Unsupported()
+                bound += 1
+            return self.limited(node, kind, bound)
+        if node_type is ast.Compare and len(node.ops) == 1 and type(node.ops[0]) not in UNSUPPORTED_COMPARISONS:
+            node.left = self.check(node.left, index)[0]
+            node.comparators[0] = self.check(node.comparators[0], index)[0]
+            return node, "bool", 1
+        raise Unsupported()
+
+    def check_operation(self, node, index):
+        left, left_kind, left_bound = self.check(node.left, index)
+        right, right_kind, right_bound = self.check(node.right, index)
+        op_type = type(node.op)
+        if op_type in BITWISE_OPERATORS and left_kind == right_kind == "bool":
+            node.left, node.right = left, right
+            return node, "bool", 1
+        left, left_kind, left_bound = self.as_number(left, left_kind, left_bound)
+        right, right_kind, right_bound = self.as_number(right, right_kind, right_bound)
+        if left_kind == "float" or right_kind == "float" or op_type is ast.Div:
+            if op_type not in FLOAT_OPERATORS:
+                raise Unsupported()
+            kind, bound = "float", None
+        elif op_type is ast.Add or op_type is ast.Sub:
+            kind, bound = "int", left_bound + right_bound
+        elif op_type is ast.Mult:
+            kind, bound = "int", left_bound * right_bound
+        elif op_type is ast.FloorDiv:
+            kind, bound = "int", max(left_bound, 1)
+        elif op_type is ast.Mod:
+            kind, bound = "int", right_bound
+        elif op_type is ast.LShift or op_type is ast.RShift:
+            if right_bound >= 63:
+                raise Unsupported()
+            kind, bound = "int", left_bound << right_bound if op_type is ast.LShift else left_bound
+        elif op_type in BITWISE_OPERATORS:
+            kind, bound = "int", 2 * max(left_bound, right_bound) + 1
+        else:
+            raise Unsupported()
+        if op_type in GUARDED_OPERATORS:
+            arguments = [ast.Constant(index, **HERE), ast.Constant(GUARDED_OPERATORS[op_type], **HERE), left, right]
+            node = ast.Call(ast.Name("_slacc_guarded", ast.Load(), **HERE), arguments, [], **HERE)
+        else:
+            node.left, node.right = left, right
+        return self.limited(node, kind, bound)
+
+    @staticmethod
+    def as_number(node, kind, bound):
+        # booleans take part in arithmetic as the integers they are in Python, which NumPy does not do
+        if kind == "bool":
+            return ast.BinOp(node, ast.Mult(), ast.Constant(1, **HERE), **HERE), "int", 1
+        return node, kind, bound
+
+    @staticmethod
+    def limited(node, kind, bound):
+        if kind == "int" and bound > INTEGER_LIMIT:
+            raise Unsupported()
+        return node, kind, bound
+